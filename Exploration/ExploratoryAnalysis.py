@@ -1,8 +1,8 @@
 import pandas as pd
 import numpy as np
-from ast import literal_eval
 import os
 import Exploration.plotting as pl
+from Preprocessing.table_io import read_table
 import seaborn as sns
 import matplotlib.pyplot as plt
 from pandas.api.types import is_numeric_dtype
@@ -54,7 +54,7 @@ def summarize(df, do_print=True, fpath=None, head=True, values=True):
 def analyze_instagram_dataset(input_path, output_folder, skip_if_exists=False):
     """
     Does basic summary and plotting of the values in a  dataset as output by Pipeline.Preprocessing.Preprocessor
-    :param input_path: path to a csv file
+    :param input_path: path to a csv or parquet file
     :param output_folder: path to the folder where the output will be stored
     :param skip_if_exists: skip plots that already exist on disk
     """
@@ -64,9 +64,9 @@ def analyze_instagram_dataset(input_path, output_folder, skip_if_exists=False):
 
     os.makedirs(output_folder, exist_ok=True)
 
-    converters = {"timestamp": pd.to_datetime, "hashtags": literal_eval,
-                  "caption_en": lambda x: "" if pd.isna(x) else str(x)}
-    df = pd.read_csv(input_path, index_col="timestamp", converters=converters)
+    df = read_table(input_path, index_col="timestamp", list_columns=["hashtags"], datetime_columns=["timestamp"])
+    if "caption_en" in df.columns:
+        df["caption_en"] = df["caption_en"].fillna("").astype(str)
 
     save_path = os.path.join(output_folder, "{}")
 
@@ -0,0 +1,155 @@
+"""
+Finds near-duplicate images (reposts and re-uploads of the same photo) in an image folder with perceptual hashes.
+Every image is hashed with a dHash (difference hash) of its downscaled grayscale version: re-encoding, rescaling and
+small edits only flip a few bits, so near-duplicates have hashes within a small Hamming distance of each other.
+The pairs within the distance are found with a multi-index lookup instead of comparing all pairs: the hashes are split into
+max_distance + 1 chunks, and two hashes within max_distance bits of each other agree on at least one chunk (pigeonhole),
+so only hashes that share a chunk are compared. Connected pairs form a duplicate group (union-find).
+"""
+
+import os
+import shutil
+import cv2
+import pandas as pd
+from tqdm import tqdm
+from Preprocessing.table_io import write_table
+
+
+def dhash(image_path, hash_size=8):
+    """
+    :param image_path: path to the image
+    :param hash_size: the hash has hash_size * hash_size bits
+    :return: hash as python int, None if the image can't be read
+    """
+    image = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if image is None:
+        return None
+    small = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+class UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i != root_j:
+            self.parent[max(root_i, root_j)] = min(root_i, root_j)
+
+
+def find_duplicate_groups(hashes, max_distance=4, n_bits=64):
+    """
+    :param hashes: list of hashes (python ints)
+    :param max_distance: maximum number of differing bits of near-duplicates
+    :param n_bits: number of bits of the hashes
+    :return: group id of every hash (the index of the first hash of the group)
+    """
+    # identical hashes (exact reposts) are grouped directly, the lookup only runs on the distinct hashes
+    unique = list(dict.fromkeys(hashes))
+    position = {h: i for i, h in enumerate(unique)}
+    union_find = UnionFind(len(unique))
+
+    n_chunks = min(max_distance + 1, n_bits)
+    bounds = [n_bits * chunk // n_chunks for chunk in range(n_chunks + 1)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        mask = (1 << (end - start)) - 1
+        buckets = {}
+        for i, h in enumerate(unique):
+            buckets.setdefault((h >> start) & mask, []).append(i)
+        for bucket in buckets.values():
+            for a in range(len(bucket)):
+                for b in range(a + 1, len(bucket)):
+                    i, j = bucket[a], bucket[b]
+                    if bin(unique[i] ^ unique[j]).count("1") <= max_distance:
+                        union_find.union(i, j)
+
+    first = {}  # root -> index of the first hash in the group
+    groups = []
+    for index, h in enumerate(hashes):
+        root = union_find.find(position[h])
+        groups.append(first.setdefault(root, index))
+    return groups
+
+
+class ImageDeduplicator:
+    """
+    Writes a table of all images in an image folder with their hash and duplicate group:
+    - image: image file name
+    - dhash: perceptual hash (hex)
+    - duplicate_group: name of the image that represents the group (the largest file, i.e. most likely the best quality upload)
+    - is_duplicate: True for all images of a group except the representative
+    Images that can't be read get no hash and are their own group.
+    """
+
+    def __init__(self, image_folder, output_path, max_distance=4, hash_size=8, move_duplicates=False, skip_if_exists=False,
+                 export_csv=False):
+        """
+        :param image_folder: input folder
+        :param output_path: output table (csv or parquet)
+        :param max_distance: maximum number of differing hash bits of near-duplicates (0 = only identical hashes)
+        :param hash_size: the hashes have hash_size * hash_size bits
+        :param move_duplicates: move the duplicates (all images of a group except the representative) out of the image folder
+                                into a 'duplicates' folder next to it, so the following stages don't process them
+        :param skip_if_exists: skip if the output table already exists
+        :param export_csv: if the output is a parquet file, additionally export it as csv
+        """
+        self.image_folder = image_folder
+        self.output_path = output_path
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.move_duplicates = move_duplicates
+        self.duplicates_folder = os.path.join(os.path.dirname(os.path.normpath(image_folder)), "duplicates")
+        self.skip_if_exists = skip_if_exists
+        self.export_csv = export_csv
+
+    def run(self):
+        if self.skip_if_exists and os.path.exists(self.output_path):
+            print("Output file already exists. Skipping. Output file at {}".format(self.output_path))
+            return
+
+        images = sorted(os.listdir(self.image_folder))
+        # previously moved duplicates are hashed again so the groups stay complete
+        moved = sorted(os.listdir(self.duplicates_folder)) if os.path.exists(self.duplicates_folder) else []
+        paths = [os.path.join(self.image_folder, img) for img in images] + [os.path.join(self.duplicates_folder, img) for img in moved]
+        hashes = [dhash(path, self.hash_size) for path in tqdm(paths)]
+
+        readable = [i for i, h in enumerate(hashes) if h is not None]
+        groups = list(range(len(paths)))
+        for i, group in zip(readable, find_duplicate_groups([hashes[i] for i in readable], self.max_distance, self.hash_size ** 2)):
+            groups[i] = readable[group]
+
+        df = pd.DataFrame({"image": images + moved, "group": groups, "size": [os.path.getsize(path) for path in paths],
+                           "dhash": [None if h is None else "{:0{}x}".format(h, self.hash_size ** 2 // 4) for h in hashes]})
+        representatives = df.sort_values(["size", "image"], ascending=[False, True]).groupby("group")["image"].first()
+        df["duplicate_group"] = df["group"].map(representatives)
+        df["is_duplicate"] = df["image"] != df["duplicate_group"]
+        df = df[["image", "dhash", "duplicate_group", "is_duplicate"]]
+        n_groups = df.loc[df["is_duplicate"], "duplicate_group"].nunique()
+        print("{} of {} images are near-duplicates of another image ({} groups)".format(df["is_duplicate"].sum(), len(df), n_groups))
+
+        if self.move_duplicates:
+            self._move_duplicates(set(df.loc[df["is_duplicate"], "image"]))
+
+        os.makedirs(os.path.dirname(self.output_path), exist_ok=True)
+        write_table(df, self.output_path, index=False, export_csv=self.export_csv)
+        print("Output table saved to {}".format(self.output_path))
+
+    def _move_duplicates(self, duplicates):
+        """
+        Moves the duplicates into the duplicates folder and representatives that were moved before back into the image folder
+        """
+        os.makedirs(self.duplicates_folder, exist_ok=True)
+        for img in os.listdir(self.image_folder):
+            if img in duplicates:
+                shutil.move(os.path.join(self.image_folder, img), os.path.join(self.duplicates_folder, img))
+        for img in os.listdir(self.duplicates_folder):
+            if img not in duplicates:
+                shutil.move(os.path.join(self.duplicates_folder, img), os.path.join(self.image_folder, img))
@@ -5,9 +5,11 @@ import sys
 os.environ['DB_ROOT'] = "dummy"
 
 """
-Makes the DIRtorch model available from inside a python file: constructs the shell command for running the model and executes it.
+Makes the DIRtorch model available from inside a python file: loads the model into the current process and computes the
+feature vectors of an image folder.
 This was built for usage in the Pipeline.
-You could totally just manually modify the command and run it in a shell outside of the Pipeline.
+You can also run the model in a shell outside of the Pipeline, see https://github.com/naver/deep-image-retrieval#feature-extractor
+(same settings: --whiten Landmarks_clean --whitenp 0.25)
 
 SETUP:
 1. Pull the https://github.com/naver/deep-image-retrieval repo into a folder called 'deep-image-retrieval' (if you change it to something else adapt the variable repo_folder)
@@ -16,16 +18,164 @@ SETUP:
  Alternatively download a different model and change the 'checkpoint' variable below
 """
 
+import hashlib
+import inspect
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms as trn
+from PIL import Image
+from tqdm import tqdm
+from Preprocessing.FeatureVectors.feature_store import FeatureStore
+from Preprocessing.image_cache import ImageCache, decode_views
 
-def get_features(image_folder, image_list_file, output_file, gpu_id, repo_folder="deep-image-retrieval", skip_if_exists=False):
+DEFAULT_CHECKPOINT = "dirtorch/models/Resnet101-AP-GeM-LM18.pt"
+DEFAULT_WHITEN = "Landmarks_clean"
+DEFAULT_WHITENP = 0.25
+
+
+class DIRImageDataset(Dataset):
+    """
+    Images of a folder, preprocessed like DIRtorch does for feature extraction (no resizing, only normalization)
+    Images in the DIR view of the image cache are read from the cache (already resized to the cache's dir_size)
+    """
+
+    def __init__(self, image_folder, images, mean, std, cache=None):
+        self.image_folder = image_folder
+        self.images = images
+        self.transform = trn.Compose([trn.ToTensor(), trn.Normalize(mean=mean, std=std)])
+        self.cache = cache if cache is not None and cache.has_view("dir") else None
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, i):
+        if self.cache is not None and self.cache.has("dir", self.images[i]):
+            return i, self.transform(self.cache.get("dir", self.images[i]))
+        img = Image.open(os.path.join(self.image_folder, self.images[i])).convert("RGB")
+        return i, self.transform(img)
+
+
+def size_batches(image_folder, images, batch_size, cache=None):
+    """
+    Groups the images into batches of images of the same size (images of different sizes can't be stacked into one batch
+    and DIR uses the images at their original size)
+    :param cache: ImageCache with a DIR view (all cached images have the same size)
+    :return: list of batches (lists of indices into images)
+    """
+    by_size = {}
+    for i, image in enumerate(images):
+        if cache is not None and cache.has("dir", image):
+            by_size.setdefault("cache", []).append(i)
+            continue
+        with Image.open(os.path.join(image_folder, image)) as img:  # only reads the header
+            by_size.setdefault(img.size, []).append(i)
+    return [indices[k:k + batch_size] for indices in by_size.values() for k in range(0, len(indices), batch_size)]
+
+
+def extraction_settings(checkpoint=DEFAULT_CHECKPOINT, whiten=DEFAULT_WHITEN, whitenp=DEFAULT_WHITENP, dir_size=None):
+    """
+    Everything the feature vectors depend on, stored with the vectors in the feature store (vectors computed with other
+    settings aren't comparable)
+    :param dir_size: side length of the images read from the image cache (None: images at their original size)
+    :return: dict of settings
+    """
+    # the image preprocessing and the feature post-processing are part of the settings as well
+    code = inspect.getsource(DIRImageDataset) + inspect.getsource(DIRFeatureExtractor.extract)
+    if dir_size is not None:
+        code += inspect.getsource(decode_views)
+    return {"checkpoint": checkpoint, "whiten": whiten, "whitenp": whitenp, "dir_size": dir_size,
+            "implementation": hashlib.sha1(code.encode("utf-8")).hexdigest()}
+
+
+class DIRFeatureExtractor:
+    """
+    Runs the DIRtorch model in the current process. The model and the whitening params are loaded once, when the extractor is
+    created, so one extractor can compute the features of multiple image folders (e.g. of all datasets in a batch run).
+    """
+
+    def __init__(self, repo_folder="deep-image-retrieval", checkpoint=DEFAULT_CHECKPOINT, gpu_id=-1, whiten=DEFAULT_WHITEN,
+                 whitenp=DEFAULT_WHITENP, batch_size=8, num_workers=4):
+        """
+        :param repo_folder: path to the DIRtorch repository
+        :param checkpoint: model file, relative to repo_folder
+        :param gpu_id: -1 = use CPU, 0 = first GPU, 1 = second GPU etc.
+        :param whiten: whitening params stored in the checkpoint (None = no whitening)
+        :param whitenp: whitening power
+        :param batch_size: number of images (of the same size) passed through the model at once
+        :param num_workers: number of processes loading the images
+        """
+        repo_folder = os.path.abspath(repo_folder)
+        if repo_folder not in sys.path:
+            sys.path.append(repo_folder)
+        from dirtorch.utils import common
+        from dirtorch.test_dir import load_model
+
+        self.common = common
+        self.iscuda = common.torch_set_gpu([gpu_id])
+        self.net = load_model(os.path.join(repo_folder, checkpoint), self.iscuda)
+        self.net.eval()
+        self.pca = self.net.pca[whiten] if whiten else None
+        self.whiten = {"whitenp": whitenp, "whitenv": None, "whitenm": 1.0}
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.settings = extraction_settings(checkpoint, whiten, whitenp)
+
+    def extract(self, image_folder, images, cache=None):
+        """
+        :param image_folder: image folder path
+        :param images: names of the images in the folder
+        :param cache: ImageCache of the image folder (only used if it has a DIR view)
+        :return: feature matrix (number of images, feature dimension), row i belongs to images[i]
+        """
+        from dirtorch.utils.common import pool
+
+        dataset = DIRImageDataset(image_folder, images, self.net.preprocess["mean"], self.net.preprocess["std"], cache)
+        loader = DataLoader(dataset, batch_sampler=size_batches(image_folder, images, self.batch_size, cache), num_workers=self.num_workers)
+        features = [None] * len(images)
+        with torch.inference_mode():
+            for indices, imgs in tqdm(loader, total=len(loader)):
+                if self.iscuda:
+                    imgs = imgs.cuda()
+                descs = self.net(imgs)
+                if len(descs.shape) == 1:
+                    descs = descs.unsqueeze(0)
+                for i, desc in zip(indices.tolist(), descs.cpu()):
+                    features[i] = desc
+        # same post-processing as dirtorch.extract_features with a single transformation: pool, L2 normalization, whitening
+        descs = F.normalize(pool([torch.stack(features)], "mean"), p=2, dim=1).numpy()
+        if self.pca is not None:
+            descs = self.common.whiten_features(descs, self.pca, **self.whiten)
+        return descs.astype(np.float32)
+
+
+_extractors = {}
+
+
+def get_extractor(repo_folder="deep-image-retrieval", gpu_id=-1, batch_size=8, num_workers=4):
+    """
+    :return: the extractor of the current process for the given settings (the model is only loaded once per process)
+    """
+    key = (os.path.abspath(repo_folder), gpu_id, batch_size, num_workers)
+    if key not in _extractors:
+        _extractors[key] = DIRFeatureExtractor(repo_folder, gpu_id=gpu_id, batch_size=batch_size, num_workers=num_workers)
+    return _extractors[key]
+
+
+def get_features(image_folder, image_list_file, output_file, gpu_id, repo_folder="deep-image-retrieval", skip_if_exists=False,
+                 extractor=None, batch_size=8, num_workers=4):
     """
     Runs the DIRtorch model on an image folder
     :param image_folder: path to the folder - feature vectors will be calculated for all images inside the folder
     :param image_list_file: path to the file that lists all images in image_folder - if it doesn't exist it will be created automatically
     :param output_file: path to the .npy file where the feature vectors are output
-    :param gpu_id: -1 = use CPU, 1 = first GPU, 2 = second GPU etc. You WANT to use a GPU, else the feature calculation is painfully slow.
+    :param gpu_id: -1 = use CPU, 0 = first GPU, 1 = second GPU etc. You WANT to use a GPU, else the feature calculation is painfully slow.
     :param repo_folder: path to the DIRtorch repository
     :param skip_if_exists: skip execution if the output file already exists
+    :param extractor: DIRFeatureExtractor to use (default: the extractor of the current process for repo_folder and gpu_id)
+    :param batch_size: see DIRFeatureExtractor
+    :param num_workers: see DIRFeatureExtractor
     """
 
     if os.path.exists(output_file) and skip_if_exists:
@@ -39,41 +189,81 @@ def get_features(image_folder, image_list_file, output_file, gpu_id, repo_folder
         with open(image_list_file, "w") as f:
             image_list = os.listdir(image_folder)
             f.write("\n".join(image_list))
+    with open(image_list_file) as f:
+        image_list = [line.strip() for line in f if line.strip()]
 
-    # transform the paths to be relative to the DIR directory and make sure there are to backwards slashes
-    # absolute paths throw an error during DIR execution
-    image_folder_rel = os.path.relpath(image_folder, start=repo_folder).replace(os.sep, '/')
-    image_list_file_rel = os.path.relpath(image_list_file, start=repo_folder).replace(os.sep, '/')
-    output_file_rel = os.path.relpath(output_file, start=repo_folder).replace(os.sep, '/')
+    if extractor is None:
+        extractor = get_extractor(repo_folder, gpu_id, batch_size, num_workers)
+    features = extractor.extract(image_folder, image_list)
+    np.save(output_file, features)
+    print("Output saved to {}".format(os.path.abspath(output_file)))
 
-    # ---------------------------# DIRtorch Execution
-    # we run the deep-image-retrieval model from within the deep-image-retrieval folder as indicated by the repo
-    old_cwd = os.getcwd()
-    os.chdir(repo_folder)
 
-    checkpoint = "dirtorch/models/Resnet101-AP-GeM-LM18.pt"
 
-    # create the dataset representation
+def import_features(store, npy_file, image_list_file):
     """
-    the string version of a command that will be evaluated internally by DIR,see https://github.com/naver/deep-image-retrieval#feature-extractor
-    looks something like: --dataset 'ImageList("PATH_TO_TEXTFILE" [, "IMAGES_ROOT"])'
-    where PATH_TO_TEXTFILE is a textfile that lists the image names and IMAGES_ROOT points to the image folder
-    the outer quotation marks are to deal with any space inside the command
-    quotation marks inside the command need to be escaped for the shell execution
+    Adds the vectors of a feature matrix written by get_features to a feature store
+    :param store: FeatureStore
+    :param npy_file: feature matrix
+    :param image_list_file: file that lists the image of each row
     """
-    dataset_str = r'"ImageList(\"{}\" , \"{}\")"'.format(image_list_file_rel, image_folder_rel)
+    with open(image_list_file) as f:
+        image_list = [line.strip() for line in f if line.strip()]
+    features = np.load(npy_file)
+    if len(image_list) != len(features):
+        print("{} has {} rows but {} lists {} images. Not importing it".format(npy_file, len(features), image_list_file, len(image_list)))
+        return
+    store.append(image_list, features)
+    print("Imported {} feature vectors from {}".format(len(image_list), npy_file))
 
-    print(dataset_str)
 
-    # construct the shell command
-    command = "python -m dirtorch.extract_features --dataset {} --checkpoint {} --output  \"{}\" --whiten Landmarks_clean --whitenp 0.25 --gpu {}".format(
-        dataset_str, checkpoint, output_file_rel, gpu_id)
-    print(command)
-    os.system(command)
-    # restore the old working directory
-    print("Output saved to {}".format(os.path.abspath(output_file)))
-    os.chdir(old_cwd)
-    # ---------------------------#
+def update_feature_store(image_folder, store_folder, gpu_id, repo_folder="deep-image-retrieval", extractor=None, batch_size=8,
+                         num_workers=4, shard_size=1000, export_file=None, export_image_list=None, image_cache=None, legacy_file=None,
+                         legacy_image_list=None, reset=False):
+    """
+    Adds the feature vectors of all images in image_folder that aren't in the feature store yet
+    :param image_folder: path to the image folder
+    :param store_folder: path to the FeatureStore folder
+    :param gpu_id: -1 = use CPU, 0 = first GPU, 1 = second GPU etc.
+    :param repo_folder: path to the DIRtorch repository
+    :param extractor: DIRFeatureExtractor to use (default: the extractor of the current process for repo_folder and gpu_id)
+    :param batch_size: see DIRFeatureExtractor
+    :param num_workers: see DIRFeatureExtractor
+    :param shard_size: number of images per shard (an interrupted run keeps all completed shards)
+    :param export_file: if given, additionally export all vectors into this .npy file
+    :param export_image_list: file to write the image of each exported row to (default: .txt file next to export_file)
+    :param image_cache: path to an image cache of the image folder (see Preprocessing/image_cache.py). Only used if it was built
+                        with a dir_size: the images are then read from the cache, resized to dir_size x dir_size, instead of at
+                        their original size, which changes the features (so the store is emptied
+                        when the DIR view is added or removed).
+    :param legacy_file: .npy file written by get_features, to initialize an empty store with (so its vectors aren't recomputed)
+    :param legacy_image_list: image list file of legacy_file
+    :param reset: recompute the vectors of all images
+    :return: the FeatureStore
+    """
+    cache = ImageCache(image_cache) if image_cache is not None and os.path.exists(image_cache) else None
+    dir_size = cache.views["dir"][0] if cache is not None and cache.has_view("dir") else None
+    # the store is emptied if the vectors in it were computed with other settings
+    model = extractor.settings if extractor is not None else extraction_settings()
+    settings = extraction_settings(model["checkpoint"], model["whiten"], model["whitenp"], dir_size)
+    store = FeatureStore(store_folder, settings)
+    if reset:
+        store.reset(settings)
+    # the vectors of get_features were computed with the default settings, at the original image size
+    legacy = legacy_file is not None and os.path.exists(legacy_file) and os.path.exists(legacy_image_list)
+    if legacy and not len(store) and not reset and settings == extraction_settings():
+        import_features(store, legacy_file, legacy_image_list)
+    missing = store.missing(sorted(os.listdir(image_folder)))
+    print("{} images in the feature store, {} to add".format(len(store), len(missing)))
+    if missing and extractor is None:
+        extractor = get_extractor(repo_folder, gpu_id, batch_size, num_workers)
+    for start in range(0, len(missing), shard_size):
+        shard = missing[start:start + shard_size]
+        store.append(shard, extractor.extract(image_folder, shard, cache))
+    if export_file is not None:
+        store.export(export_file, export_image_list or os.path.splitext(export_file)[0] + ".txt")
+        print("Output saved to {}".format(os.path.abspath(export_file)))
+    return store
 
 
 if __name__ == "__main__":
@@ -82,4 +272,4 @@ if __name__ == "__main__":
     stage = "06_calc_image_vectors"
     output_file = "../../data/datasets/{}/{}.npy".format(stage, casestudy)
     image_list_file = "../../data/datasets/04_download_images/{}/image_db.txt".format(casestudy)
-    get_features(image_folder, image_list_file, output_file)
+    get_features(image_folder, image_list_file, output_file, gpu_id=-1)
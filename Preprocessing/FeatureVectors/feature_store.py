@@ -0,0 +1,133 @@
+import os
+import json
+import numpy as np
+
+
+class FeatureStore:
+    """
+    Append-only on-disk store of image feature vectors with an explicit image name -> row index.
+    New images are added in shards (one shard per extraction batch), so adding images never recomputes or rewrites the
+    vectors that are already stored, and an interrupted extraction keeps all shards that were completed.
+
+    Files in the store folder:
+    - features.f32: the vectors of all shards (float32, row-major), appended one shard after another. All rows can
+      therefore be read as a single memory-mapped (rows, dim) array.
+    - index.json: vector dimension, the settings the vectors were computed with, the shards (first row, number of rows) and
+      the image name -> row mapping
+    The index is written after the shard, so it never points to rows that don't exist. Rows after the last indexed
+    shard (a shard that was cut off when the extraction was interrupted) are dropped on opening the store.
+    """
+
+    dtype = np.float32
+
+    def __init__(self, folder, settings=None):
+        """
+        :param folder: path to the store folder (created if it doesn't exist)
+        :param settings: json-serializable settings the vectors are computed with (e.g. model, whitening, preprocessing).
+                         If they differ from the settings of the stored vectors, the store is emptied, so it never mixes
+                         vectors that aren't comparable. None: keep the store as it is.
+        """
+        self.folder = folder
+        self.data_path = os.path.join(folder, "features.f32")
+        self.index_path = os.path.join(folder, "index.json")
+        os.makedirs(folder, exist_ok=True)
+        self.dim = None
+        self.settings = None
+        self.shards = []
+        self.rows = {}  # image name -> row
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.dim, self.settings, self.shards, self.rows = index["dim"], index.get("settings"), index["shards"], index["images"]
+        if settings is not None and self.settings != json.loads(json.dumps(settings)):
+            if len(self):
+                print("Feature settings changed. Emptying the feature store")
+            self.reset(settings)
+        end = len(self) * (self.dim or 0) * np.dtype(self.dtype).itemsize
+        if os.path.exists(self.data_path) and os.path.getsize(self.data_path) > end:
+            with open(self.data_path, "r+b") as f:
+                f.truncate(end)
+
+    def reset(self, settings=None):
+        """
+        Deletes all vectors
+        :param settings: settings of the vectors that will be added (see __init__)
+        """
+        if os.path.exists(self.data_path):
+            os.remove(self.data_path)
+        self.dim, self.shards, self.rows = None, [], {}
+        self.settings = json.loads(json.dumps(settings)) if settings is not None else None
+        self._write_index()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, image):
+        return image in self.rows
+
+    def names(self):
+        """
+        :return: image names in row order
+        """
+        return list(self.rows.keys())
+
+    def row(self, image):
+        return self.rows[image]
+
+    def missing(self, images):
+        """
+        :return: the images that don't have a vector in the store yet
+        """
+        return [image for image in images if image not in self.rows]
+
+    def append(self, images, features):
+        """
+        Adds a shard
+        :param images: image names
+        :param features: (len(images), dim) matrix, row i belongs to images[i]
+        """
+        features = np.ascontiguousarray(features, dtype=self.dtype)
+        if features.ndim != 2 or features.shape[0] != len(images):
+            raise ValueError("Expected a ({}, dim) feature matrix, got {}".format(len(images), features.shape))
+        if self.dim is None:
+            self.dim = features.shape[1]
+        elif features.shape[1] != self.dim:
+            raise ValueError("Feature dimension {} doesn't match the store's dimension {}".format(features.shape[1], self.dim))
+        duplicates = [image for image in images if image in self.rows]
+        if duplicates or len(set(images)) != len(images):
+            raise ValueError("Images are already in the store or given twice: {}".format(duplicates[:5]))
+
+        start = len(self)
+        with open(self.data_path, "ab") as f:
+            f.write(features.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.shards.append([start, len(images)])
+        for i, image in enumerate(images):
+            self.rows[image] = start + i
+        self._write_index()
+
+    def _write_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self.dim, "settings": self.settings, "shards": self.shards, "images": self.rows}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def features(self):
+        """
+        :return: read-only memory-mapped (rows, dim) array of all vectors (row order as given by names())
+        """
+        if not len(self):
+            return np.zeros((0, self.dim or 0), dtype=self.dtype)
+        return np.memmap(self.data_path, dtype=self.dtype, mode="r", shape=(len(self), self.dim))
+
+    def export(self, npy_path, image_list_file=None):
+        """
+        Writes all vectors into a single .npy file (the format of the former image_features.npy)
+        :param npy_path: output .npy file
+        :param image_list_file: output file that lists the image of each row (one name per line)
+        """
+        np.save(npy_path, self.features())
+        if image_list_file is not None:
+            with open(image_list_file, "w") as f:
+                f.write("\n".join(self.names()))
@@ -0,0 +1,163 @@
+"""
+Image retrieval over DIR feature vectors: exact cosine similarity search with blocked matrix products.
+The index holds the L2-normalized vectors of one or more feature stores (e.g. the Hamburg 2009, 2014 and 2019 datasets)
+as a memory-mapped float32 matrix. Queries are multiplied with one block of rows at a time, so the search never loads the
+whole matrix into memory and every block is a single BLAS call.
+
+Usage:
+    index = RetrievalIndex.build("data/retrieval_index", {"hamburg19": FeatureStore("data/hamburg19/image_features")})
+    index = RetrievalIndex("data/retrieval_index")  # later: load the persisted index
+    index.query_image("hamburg19/123.jpg", k=10)  # [(image, similarity), ...]
+    index.within_threshold("hamburg19/123.jpg", 0.15)  # all images showing the same landmark (see readme.md)
+    index.match_counts(0.15)  # number of matches of every image per dataset
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class RetrievalIndex:
+    """
+    Files in the index folder:
+    - vectors.f32: L2-normalized vectors (float32, row-major)
+    - index.json: vector dimension, image names in row order and the rows of each source (dataset)
+    Image names are prefixed with their source ("[source]/[image]").
+    """
+
+    def __init__(self, folder, block_size=8192):
+        """
+        :param folder: folder of an index created with RetrievalIndex.build
+        :param block_size: number of index rows multiplied with the queries at once
+        """
+        self.folder = folder
+        self.block_size = block_size
+        with open(os.path.join(folder, "index.json")) as f:
+            index = json.load(f)
+        self.dim, self.names, self.sources = index["dim"], index["images"], index["sources"]
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        if self.names:
+            self.vectors = np.memmap(os.path.join(folder, "vectors.f32"), dtype=np.float32, mode="r", shape=(len(self.names), self.dim))
+        else:
+            self.vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+
+    @classmethod
+    def build(cls, folder, stores, block_size=8192):
+        """
+        Creates the index (overwrites an existing index in the folder)
+        :param folder: index folder
+        :param stores: dict of source name -> FeatureStore
+        :param block_size: number of rows copied at once
+        :return: the RetrievalIndex
+        """
+        os.makedirs(folder, exist_ok=True)
+        names, sources, dim = [], {}, None
+        with open(os.path.join(folder, "vectors.f32"), "wb") as f:
+            for source, store in stores.items():
+                if not len(store):
+                    continue
+                if dim is not None and store.dim != dim:
+                    raise ValueError("Feature dimension of {} ({}) doesn't match the other sources ({})".format(source, store.dim, dim))
+                dim = store.dim
+                features = store.features()
+                for start in range(0, len(features), block_size):
+                    f.write(_normalize(features[start:start + block_size]).tobytes())
+                sources[source] = [len(names), len(names) + len(store)]
+                names.extend("{}/{}".format(source, name) for name in store.names())
+        with open(os.path.join(folder, "index.json"), "w") as f:
+            json.dump({"dim": dim, "images": names, "sources": sources}, f)
+        return cls(folder, block_size=block_size)
+
+    def __len__(self):
+        return len(self.names)
+
+    def vector(self, image):
+        return np.asarray(self.vectors[self.rows[image]])
+
+    def _blocks(self):
+        for start in range(0, len(self), self.block_size):
+            yield start, self.vectors[start:start + self.block_size]
+
+    def search(self, queries, k=10):
+        """
+        Top-k search for a batch of query vectors
+        :param queries: (number of queries, dim) matrix
+        :param k: number of results per query
+        :return: similarities and rows, both (number of queries, k) and sorted by descending similarity
+        """
+        queries = _normalize(np.atleast_2d(queries))
+        k = min(k, len(self))
+        if k == 0:
+            return np.zeros((len(queries), 0), dtype=np.float32), np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        for start, block in self._blocks():
+            scores = np.concatenate([best_scores, queries @ block.T], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))], axis=1)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_rows = np.take_along_axis(rows, top, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+    def query_vector(self, vector, k=10):
+        """
+        :return: the k most similar images to the vector as list of (image, similarity)
+        """
+        scores, rows = self.search(vector, k)
+        return [(self.names[row], float(score)) for score, row in zip(scores[0], rows[0])]
+
+    def query_image(self, image, k=10):
+        """
+        :param image: image name in the index ("[source]/[image]")
+        :return: the k most similar other images as list of (image, similarity)
+        """
+        return [(name, score) for name, score in self.query_vector(self.vector(image), k + 1) if name != image][:k]
+
+    def within_threshold(self, query, threshold):
+        """
+        :param query: image name in the index or vector
+        :param threshold: minimum cosine similarity (for the Hamburg datasets 0.1 - 0.2 means same landmark)
+        :return: all images (except the query image) with a similarity of at least the threshold as list of (image, similarity),
+                 sorted by descending similarity
+        """
+        vector = _normalize(np.atleast_2d(self.vector(query) if isinstance(query, str) else query))[0]
+        matches = []
+        for start, block in self._blocks():
+            scores = block @ vector
+            for row in np.flatnonzero(scores >= threshold):
+                matches.append((self.names[start + row], float(scores[row])))
+        return sorted([match for match in matches if match[0] != query], key=lambda match: -match[1])
+
+    def match_counts(self, threshold, query_block_size=1024):
+        """
+        Counts for every image how many other images of each source are at least threshold similar (e.g. how often the
+        landmark of an image occurs in each dataset). All pairs are compared, but block by block.
+        :param threshold: minimum cosine similarity
+        :param query_block_size: number of images compared with the index at once
+        :return: DataFrame indexed by image with the source of the image and one count column per source
+        """
+        counts = np.zeros((len(self), len(self.sources)), dtype=np.int64)
+        bounds = [bound for bound in self.sources.values()]
+        for q_start in tqdm(range(0, len(self), query_block_size)):
+            queries = np.asarray(self.vectors[q_start:q_start + query_block_size])
+            for start, block in self._blocks():
+                matches = (queries @ block.T) >= threshold
+                # don't count an image as its own match
+                overlap = range(max(q_start, start), min(q_start + len(queries), start + len(block)))
+                matches[np.array(overlap, dtype=np.int64) - q_start, np.array(overlap, dtype=np.int64) - start] = False
+                for i, (source_start, source_end) in enumerate(bounds):
+                    lo, hi = max(source_start, start) - start, min(source_end, start + len(block)) - start
+                    if lo < hi:
+                        counts[q_start:q_start + len(queries), i] += matches[:, lo:hi].sum(axis=1)
+        df = pd.DataFrame(counts, index=pd.Index(self.names, name="image"), columns=list(self.sources.keys()))
+        df.insert(0, "source", [source for source, (start, end) in self.sources.items() for _ in range(end - start)])
+        return df
@@ -1,8 +1,65 @@
 import cv2
 from tqdm import tqdm
 import os
-import numpy as np
-from .anonymization.anonymize_face import anonymize_image_from_path
+import shutil
+from multiprocessing import Pool
+from .anonymization.anonymize_face import FaceDetector, pixelate_faces
+from Preprocessing.image_cache import ImageCache
+
+_detector = None  # face detector of the current (worker) process
+_cache = None  # image cache of the current (worker) process
+
+
+def _init_worker(single_threaded=False, cache_folder=None):
+    """
+    Loads the face detector of a worker process
+    :param single_threaded: let OpenCV use a single thread (the parallelism comes from the worker processes)
+    :param cache_folder: image cache to read the face detector inputs from (None: decode every image)
+    """
+    global _detector, _cache
+    if single_threaded:
+        cv2.setNumThreads(1)
+    _detector = FaceDetector()
+    _cache = ImageCache(cache_folder) if cache_folder is not None else None
+
+
+def _write_anonymized(img_path, output_path, image, boxes):
+    """
+    Pixelates the faces and writes the image. Images without faces aren't re-encoded: they are copied, or left as they are
+    if the images are anonymized in-place.
+    :param image: decoded image (None: decode it only if it has faces)
+    """
+    if len(boxes):
+        image = pixelate_faces(cv2.imread(img_path) if image is None else image, boxes)
+        cv2.imwrite(output_path, image)
+        if output_path == img_path and _cache is not None and os.path.basename(img_path) in _cache:
+            # don't keep the faces in the cache either
+            _cache.update(os.path.basename(img_path), output_path)
+    elif output_path != img_path:
+        shutil.copyfile(img_path, output_path)
+
+
+def _anonymize_files(tasks):
+    """
+    Anonymizes a batch of images (the faces of all images are detected in one forward pass)
+    Cached images are detected on their cached 300x300 version and only decoded if they have faces.
+    :param tasks: list of tuples of (input image path, output image path, confidence)
+    :return: number of images
+    """
+    confidence = tasks[0][2]
+    is_cached = [_cache is not None and _cache.has("ssd", os.path.basename(img_path)) for img_path, _, _ in tasks]
+    cached = [task for task, in_cache in zip(tasks, is_cached) if in_cache]
+    uncached = [task for task, in_cache in zip(tasks, is_cached) if not in_cache]
+    if cached:
+        names = [os.path.basename(img_path) for img_path, _, _ in cached]
+        boxes = _detector.detect_batch(_cache.get_batch("ssd", names), confidence, sizes=[_cache.size(name) for name in names])
+        for (img_path, output_path, _), image_boxes in zip(cached, boxes):
+            _write_anonymized(img_path, output_path, None, image_boxes)
+    if uncached:
+        images = [cv2.imread(img_path) for img_path, _, _ in uncached]
+        for (img_path, output_path, _), image, image_boxes in zip(uncached, images, _detector.detect_batch(images, confidence)):
+            _write_anonymized(img_path, output_path, image, image_boxes)
+    return len(tasks)
 
 
 class ImageAnonymizer:
@@ -11,19 +68,27 @@ class ImageAnonymizer:
     Uses the functionality and net provided by IDP 1 (Lukas Vordemann)
     """
 
-    def __init__(self, image_folder, output_folder, confidence=0.2, in_place=False, skip_if_exists=False):
+    def __init__(self, image_folder, output_folder, confidence=0.2, in_place=False, skip_if_exists=False, n_workers=1, batch_size=8,
+                 image_cache=None):
         """
         :param image_folder: input folder
         :param output_folder: pixelated images will be stored here. Not used if in_place=True.
         :param confidence: 0-1 value indicating how easily the face recognition tries to find faces 0=very aggresive, 1=not
         :param in_place: if true, replace the input images with the pixelated versions
         :param skip_if_exists: skip if the input images have already been pixelated
+        :param n_workers: number of processes anonymizing images in parallel (each loads its own face detector)
+        :param batch_size: number of images the faces are detected in at once
+        :param image_cache: path to an image cache of the input folder (see Preprocessing/image_cache.py) to read the face detector
+                            inputs from. Only images with faces are decoded then.
         """
         self.image_folder = image_folder
         self.output_folder = output_folder
         self.confidence = confidence
         self.in_place = in_place
         self.skip_if_exists = skip_if_exists
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.image_cache = image_cache if image_cache is not None and os.path.exists(image_cache) else None
 
     def run(self):
         if self.in_place:
@@ -37,15 +102,25 @@ class ImageAnonymizer:
             os.makedirs(self.output_folder, exist_ok=True)
         images = os.listdir(self.image_folder)
 
-        for img in tqdm(images):
+        tasks = []
+        for img in images:
             img_path = os.path.join(self.image_folder, img)
-            if self.skip_if_exists and os.path.exists(img_path) and not self.in_place:
+            output_path = img_path if self.in_place else os.path.join(self.output_folder, img)
+            if self.skip_if_exists and os.path.exists(output_path) and not self.in_place:
                 continue
-            frame = anonymize_image_from_path(img_path, preset_confidence=self.confidence)
-            if self.in_place:
-                cv2.imwrite(img_path, frame)
+            tasks.append((img_path, output_path, self.confidence))
+
+        batches = [tasks[i:i + self.batch_size] for i in range(0, len(tasks), self.batch_size)]
+        with tqdm(total=len(tasks)) as progress:
+            if self.n_workers > 1:
+                with Pool(self.n_workers, initializer=_init_worker, initargs=(True, self.image_cache)) as pool:
+                    # imap returns the results in order, so the progress bar advances batch by batch
+                    for n_images in pool.imap(_anonymize_files, batches):
+                        progress.update(n_images)
             else:
-                cv2.imwrite(os.path.join(self.output_folder, img), frame)
+                _init_worker(cache_folder=self.image_cache)
+                for batch in batches:
+                    progress.update(_anonymize_files(batch))
 
         if self.in_place:
             os.makedirs(anon_folder)
@@ -8,6 +8,7 @@ import base64
 import numpy as np
 import cv2
 import os
+from functools import lru_cache
 
 
 PROTO_TXT_ARGUMENTS = "pyimagesearch,deploy.prototxt".split(",")
@@ -15,33 +16,95 @@ WEIGHTS_MODEL_ARGUMENTS = "pyimagesearch,res10_300x300_ssd_iter_140000.caffemode
 PROTO_TXT = os.path.join(*PROTO_TXT_ARGUMENTS)
 WEIGHTS_MODEL = os.path.join(*WEIGHTS_MODEL_ARGUMENTS)
 
-def anonymize_image(image, preset_confidence, blocks=3):
-    proto_txt = os.path.join(os.path.dirname(os.path.realpath(__file__)), PROTO_TXT)
-    weights_model = os.path.join(os.path.dirname(os.path.realpath(__file__)), WEIGHTS_MODEL)
-    net = cv2.dnn.readNet(proto_txt, weights_model)
-    image_pixeled = image.copy()
-    (h, w) = image_pixeled.shape[:2]
+class FaceDetector:
+    """
+    Face detection with the Caffe SSD face detector (res10_300x300). The net is loaded once, when the detector is created,
+    so create one detector per process and reuse it for all images.
+    """
 
-    # construct blob
-    blob = cv2.dnn.blobFromImage(image_pixeled, 1.0, (300, 300), (104.0, 177.0, 123.0))
+    def __init__(self, proto_txt=None, weights_model=None):
+        """
+        :param proto_txt: path to the net definition (default: pyimagesearch/deploy.prototxt next to this file)
+        :param weights_model: path to the weights (default: pyimagesearch/res10_300x300_ssd_iter_140000.caffemodel next to this file)
+        """
+        base_folder = os.path.dirname(os.path.realpath(__file__))
+        proto_txt = proto_txt or os.path.join(base_folder, PROTO_TXT)
+        weights_model = weights_model or os.path.join(base_folder, WEIGHTS_MODEL)
+        self.net = cv2.dnn.readNet(proto_txt, weights_model)
 
-    net.setInput(blob)
-    detections = net.forward()
+    def detect(self, image, preset_confidence):
+        """
+        :param image: BGR image
+        :param preset_confidence: minimum confidence of a detection
+        :return: list of face boxes (startX, startY, endX, endY) in image coordinates
+        """
+        return self.detect_batch([image], preset_confidence)[0]
 
-    for i in range(0, detections.shape[2]):
-        confidence = detections[0, 0, i, 2]
-        if confidence > float(preset_confidence):
-            box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-            (startX, startY, endX, endY) = box.astype("int")
-            # extract the face ROI
-            face = image_pixeled[startY:endY, startX:endX]
+    def detect_batch(self, images, preset_confidence, sizes=None):
+        """
+        Detects the faces in multiple images with a single forward pass
+        :param images: list of BGR images (of any size)
+        :param preset_confidence: minimum confidence of a detection
+        :param sizes: (height, width) to scale the boxes to, if the images were already resized (e.g. 300x300 from the image cache)
+        :return: list of face boxes per image (see detect)
+        """
+        # construct blob: every image is resized to 300x300
+        blob = cv2.dnn.blobFromImages(images, 1.0, (300, 300), (104.0, 177.0, 123.0))
 
-            face = anonymize_face_pixelate(face, blocks)
-            image_pixeled[startY:endY, startX:endX] = face
+        self.net.setInput(blob)
+        detections = self.net.forward()
 
-    return image_pixeled
+        # the detections of all images come in one list: [image id in the batch, class, confidence, startX, startY, endX, endY]
+        # with coordinates relative to the image size
+        boxes = [[] for _ in images]
+        for i in range(0, detections.shape[2]):
+            image_id, confidence = int(detections[0, 0, i, 0]), detections[0, 0, i, 2]
+            if confidence > float(preset_confidence) and 0 <= image_id < len(images):
+                (h, w) = images[image_id].shape[:2] if sizes is None else sizes[image_id]
+                box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
+                boxes[image_id].append(tuple(box.astype("int")))
+        return boxes
 
-def anonymize_face_pixelate(face_image, blocks=3):
+    def anonymize(self, image, preset_confidence, blocks=3, boxes=None):
+        """
+        :param image: BGR image (not modified)
+        :param preset_confidence: minimum confidence of a detection
+        :param blocks: number of blocks per face side
+        :param boxes: face boxes if they have been detected already
+        :return: copy of the image with the faces pixelated
+        """
+        if boxes is None:
+            boxes = self.detect(image, preset_confidence)
+        return pixelate_faces(image.copy(), boxes, blocks)
+
+    def anonymize_batch(self, images, preset_confidence, blocks=3):
+        """
+        :return: list of anonymized copies of the images (see anonymize)
+        """
+        return [self.anonymize(image, preset_confidence, blocks, boxes=boxes)
+                for image, boxes in zip(images, self.detect_batch(images, preset_confidence))]
+
+
+_default_detector = None
+
+
+def get_default_detector():
+    """
+    :return: detector shared by the module-level functions (loaded on first use)
+    """
+    global _default_detector
+    if _default_detector is None:
+        _default_detector = FaceDetector()
+    return _default_detector
+
+
+def anonymize_image(image, preset_confidence, blocks=3):
+    return get_default_detector().anonymize(image, preset_confidence, blocks)
+
+def anonymize_face_pixelate_loop(face_image, blocks=3):
+    """
+    Pixelation block by block (the original implementation, see anonymize_face_pixelate)
+    """
     # divide the input image into NxN blocks
     (h, w) = face_image.shape[:2]
     xSteps = np.linspace(0, w, blocks + 1, dtype="int")
@@ -68,9 +131,153 @@ def anonymize_face_pixelate(face_image, blocks=3):
     # return the pixelated blurred image
     return face_image
 
-    # output = np.hstack([image, image_pixeled])
-    # cv2.imshow("Output", output)
-    # cv2.waitKey(0)
+
+def _pixelation_sums(face_image, ySteps, xSteps):
+    """
+    :return: per block: sum of the pixels that still have their original colour when the loop computes the block's mean
+             (blocks x blocks x channels)
+    """
+    # sum of a rectangle [ya, yb) x [xa, xb) = I[yb, xb] - I[ya, xb] - I[yb, xa] + I[ya, xa]
+    integral = cv2.integral(face_image)
+    rows, rows_below = integral[ySteps], integral[ySteps[:-1] + 1]
+    # I at the block corners (G), one pixel right of the top left corner (Gx), one pixel below it (Gy) and both (Gxy)
+    G, Gx = rows[:, xSteps], rows[:, xSteps[:-1] + 1]
+    Gy, Gxy = rows_below[:, xSteps], rows_below[:, xSteps[:-1] + 1]
+    corners = G[:-1, :-1]
+    sums = G[1:, 1:] - G[:-1, 1:] - G[1:, :-1] + corners
+    # first column of the blocks with a left neighbour
+    sums[:, 1:] -= (Gx[1:] - Gx[:-1] - G[1:, :-1] + corners)[:, 1:]
+    # first row of the blocks with an upper neighbour
+    sums[1:] -= (Gy[:, 1:] - G[:-1, 1:] - Gy[:, :-1] + corners)[1:]
+    # their top left pixel has been subtracted twice
+    sums[1:, 1:] += (Gxy - Gx[:-1] - Gy[:, :-1] + corners)[1:, 1:]
+    return sums.astype(np.float64)
+
+
+@lru_cache(maxsize=None)
+def _diagonal_order(blocks):
+    """
+    Blocks sorted by anti-diagonal: the blocks of a diagonal only depend on the previous diagonal
+    :return: (row and column of each block, start of each diagonal, flat indices of each block, its left and its upper neighbour)
+             The flat indices are for colours stored with a zero row and column in front, so the neighbours of the first row/column
+             can be indexed.
+    """
+    i, j = np.indices((blocks, blocks)).reshape(2, -1)
+    order = np.argsort(i + j, kind="stable")
+    i, j = i[order], j[order]
+    diagonal_starts = np.searchsorted(i + j, np.arange(2 * blocks))
+    own, left, up = (i + 1) * (blocks + 1) + j + 1, (i + 1) * (blocks + 1) + j, i * (blocks + 1) + j + 1
+    return i, j, diagonal_starts, own, left, up
+
+
+def _pixelation_colours(sums, heights, widths):
+    """
+    Block colours of the pixelation loop
+    :param sums: (faces, blocks, blocks, channels) see _pixelation_sums
+    :param heights: (faces, blocks) block heights
+    :param widths: (faces, blocks) block widths
+    :return: (faces, blocks, blocks, channels) uint8 colours
+    """
+    n, blocks = heights.shape
+    # number of pixels with the colour of the left/upper neighbour
+    left_counts = np.repeat(heights[:, :, None], blocks, axis=2)
+    left_counts[:, :, 0] = 0
+    up_counts = np.repeat(widths[:, None, :] - 1, blocks, axis=1)
+    up_counts[:, :, 0] += 1
+    up_counts[:, 0] = 0
+    # cv2.mean multiplies the sum by 1 / number of pixels
+    scales = 1. / (heights[:, :, None] * widths[:, None, :])
+
+    i, j, diagonal_starts, own, left, up = _diagonal_order(blocks)
+    sums, scales = sums[:, i, j], scales[:, i, j, None]
+    left_counts, up_counts = left_counts[:, i, j, None], up_counts[:, i, j, None]
+    colours = np.zeros((n, (blocks + 1) ** 2, sums.shape[-1]))
+    for d in range(2 * blocks - 1):
+        k = slice(diagonal_starts[d], diagonal_starts[d + 1])
+        total = sums[:, k] + left_counts[:, k] * colours[:, left[k]] + up_counts[:, k] * colours[:, up[k]]
+        colours[:, own[k]] = np.floor(total * scales[:, k])  # truncated like int(mean)
+    return colours.reshape(n, blocks + 1, blocks + 1, -1)[:, 1:, 1:].astype(np.uint8)
+
+
+def _pixelate_face_batch(faces, blocks):
+    """
+    Pixelates faces (views of images, in place) that all have at least blocks pixels per side
+    """
+    steps = [(np.linspace(0, face.shape[0], blocks + 1, dtype="int"), np.linspace(0, face.shape[1], blocks + 1, dtype="int"))
+             for face in faces]
+    sums = np.stack([_pixelation_sums(face, ySteps, xSteps) for face, (ySteps, xSteps) in zip(faces, steps)])
+    heights = np.stack([np.diff(ySteps) for ySteps, _ in steps])
+    widths = np.stack([np.diff(xSteps) for _, xSteps in steps])
+    colours = _pixelation_colours(sums, heights, widths)
+    for face, face_colours, face_heights, face_widths in zip(faces, colours, heights, widths):
+        face[:] = np.repeat(np.repeat(face_colours, face_widths, axis=1), face_heights, axis=0)
+
+
+# below this number of blocks per side, the loop is faster than the vectorized pixelation (see benchmark_pixelation.py)
+MIN_VECTORIZED_BLOCKS = 5
+
+
+def _can_vectorize(face_image, blocks):
+    (h, w) = face_image.shape[:2]
+    # with fewer pixels than blocks, some blocks are empty, which the loop handles in its own way
+    return blocks >= MIN_VECTORIZED_BLOCKS and h >= blocks and w >= blocks and face_image.ndim == 3 and face_image.shape[2] == 3
+
+
+def anonymize_face_pixelate(face_image, blocks=3):
+    """
+    Pixelates a face: divides it into blocks x blocks blocks and fills each block with its mean colour (in place).
+    Computes the same result as the block by block loop (anonymize_face_pixelate_loop) from block sums: the loop fills each
+    block including its right and bottom border (cv2.rectangle), so the first column and row of a block already hold the colour
+    of its left and upper neighbour when its mean is computed.
+    For less than MIN_VECTORIZED_BLOCKS blocks per side, the loop is used.
+    :param face_image: BGR image (view) of the face
+    :param blocks: number of blocks per side
+    :return: face_image
+    """
+    if not _can_vectorize(face_image, blocks):
+        return anonymize_face_pixelate_loop(face_image, blocks)
+    _pixelate_face_batch([face_image], blocks)
+    return face_image
+
+
+def _box_ranges(shape, box):
+    """
+    :return: rows and columns of the image the box slices ((start, stop), (start, stop))
+    """
+    (startX, startY, endX, endY) = box
+    return slice(startY, endY).indices(shape[0])[:2], slice(startX, endX).indices(shape[1])[:2]
+
+
+def _overlap(range_a, range_b):
+    return max(range_a[0], range_b[0]) < min(range_a[1], range_b[1])
+
+
+def pixelate_faces(image, boxes, blocks=3):
+    """
+    Pixelates all faces of an image (in place). The block colours of all faces are computed at once.
+    :param image: BGR image
+    :param boxes: face boxes (startX, startY, endX, endY)
+    :param blocks: number of blocks per face side
+    :return: image
+    """
+    # a face overlapping an earlier one is pixelated on top of the earlier (already pixelated) face,
+    # so the faces are pixelated in levels: each face one level after the last earlier face it overlaps
+    ranges = [_box_ranges(image.shape, box) for box in boxes]
+    levels = []
+    for k, (rows, columns) in enumerate(ranges):
+        levels.append(max([levels[m] + 1 for m in range(k) if _overlap(rows, ranges[m][0]) and _overlap(columns, ranges[m][1])],
+                          default=0))
+
+    for level in range(max(levels, default=-1) + 1):
+        faces = [image[startY:endY, startX:endX] for (startX, startY, endX, endY), face_level in zip(boxes, levels) if face_level == level]
+        for face in faces:
+            if not _can_vectorize(face, blocks):
+                anonymize_face_pixelate_loop(face, blocks)
+        faces = [face for face in faces if _can_vectorize(face, blocks)]
+        if faces:
+            _pixelate_face_batch(faces, blocks)
+    return image
+
 
 def anonymize_base64_image(image_base64, preset_confidence, blocks=3):
     image_bytes = base64.b64decode(image_base64)
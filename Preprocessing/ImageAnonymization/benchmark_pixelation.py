@@ -0,0 +1,86 @@
+"""
+Benchmark of the face pixelation: block by block loop (anonymize_face_pixelate_loop) vs. the vectorized version
+(anonymize_face_pixelate) for different face sizes and block counts, plus a crowd photo with many faces (pixelate_faces).
+Also checks that both produce the same pixels: first on random images with many (partly overlapping and clipped) faces and
+high block counts (check_exact raises an AssertionError on the first difference), then in every benchmark case (max diff).
+Run from the repository root: python -m Preprocessing.ImageAnonymization.benchmark_pixelation
+"""
+
+import time
+import numpy as np
+import pandas as pd
+from Preprocessing.ImageAnonymization.anonymization.anonymize_face import anonymize_face_pixelate, anonymize_face_pixelate_loop, \
+    pixelate_faces
+
+
+def time_per_call(func, image, repeats):
+    """
+    :return: (seconds per call, output of the last call)
+    """
+    tic = time.perf_counter()
+    for _ in range(repeats):
+        out = func(image.copy())
+    return (time.perf_counter() - tic) / repeats, out
+
+
+def pixelate_loop(image, boxes, blocks):
+    """
+    The faces pixelated one after another with the loop (the original implementation)
+    """
+    for (startX, startY, endX, endY) in boxes:
+        image[startY:endY, startX:endX] = anonymize_face_pixelate_loop(image[startY:endY, startX:endX], blocks)
+    return image
+
+
+def check_exact(n_images=200, seed=0):
+    """
+    Checks that pixelate_faces produces exactly the pixels of the loop
+    :param n_images: number of random images
+    """
+    rng = np.random.default_rng(seed)
+    for k in range(n_images):
+        height, width = rng.integers(100, 600, size=2)
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        blocks = int(rng.choice([3, 5, 10, 25, 50]))
+        boxes = []
+        for _ in range(rng.integers(1, 60)):
+            size = int(rng.integers(2, 200))
+            # some boxes reach over the image border, as the detector's boxes can
+            x, y = rng.integers(-20, width), rng.integers(-20, height)
+            boxes.append((max(int(x), 0), max(int(y), 0), int(x) + size, int(y) + size))
+        expected = pixelate_loop(image.copy(), boxes, blocks)
+        out = pixelate_faces(image.copy(), boxes, blocks)
+        assert np.array_equal(out, expected), "image {}: {} faces, {} blocks differ by up to {}".format(
+            k, len(boxes), blocks, np.abs(out.astype(int) - expected.astype(int)).max())
+    print("pixelate_faces matches the loop on {} random images".format(n_images))
+
+
+def benchmark(face_size, blocks, repeats=20):
+    face = np.random.randint(0, 256, (face_size, face_size, 3), dtype=np.uint8)
+    t_loop, out_loop = time_per_call(lambda x: anonymize_face_pixelate_loop(x, blocks), face, repeats)
+    t_vec, out_vec = time_per_call(lambda x: anonymize_face_pixelate(x, blocks), face, repeats)
+    return {"face size": face_size, "blocks": blocks, "loop ms": t_loop * 1e3, "vectorized ms": t_vec * 1e3,
+            "speedup": t_loop / t_vec, "max diff": np.abs(out_loop.astype(int) - out_vec.astype(int)).max()}
+
+
+def benchmark_crowd(n_faces=50, face_size=40, blocks=10, repeats=20):
+    image = np.random.randint(0, 256, (1080, 1080, 3), dtype=np.uint8)
+    # faces on a grid with some jitter, a few of them overlapping
+    per_row = int(np.ceil(np.sqrt(n_faces)))
+    spacing = (1080 - 2 * face_size) // per_row
+    boxes = []
+    for k in range(n_faces):
+        x, y = (k % per_row) * spacing + np.random.randint(0, face_size), (k // per_row) * spacing + np.random.randint(0, face_size)
+        boxes.append((x, y, x + face_size, y + face_size))
+
+    t_loop, out_loop = time_per_call(lambda x: pixelate_loop(x, boxes, blocks), image, repeats)
+    t_vec, out_vec = time_per_call(lambda x: pixelate_faces(x, boxes, blocks), image, repeats)
+    return {"face size": "{} faces of {}".format(n_faces, face_size), "blocks": blocks, "loop ms": t_loop * 1e3, "vectorized ms": t_vec * 1e3,
+            "speedup": t_loop / t_vec, "max diff": np.abs(out_loop.astype(int) - out_vec.astype(int)).max()}
+
+
+if __name__ == "__main__":
+    check_exact()
+    rows = [benchmark(face_size, blocks) for face_size in [32, 64, 128, 256, 512] for blocks in [3, 10, 25, 50] if blocks <= face_size]
+    rows += [benchmark_crowd(blocks=blocks) for blocks in [3, 10, 25]]
+    print(pd.DataFrame(rows).round(3).to_string(index=False))
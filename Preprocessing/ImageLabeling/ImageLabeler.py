@@ -4,8 +4,7 @@
 # Edited by Lukas for the Master Thesis
 
 import torch
-from torch.autograd import Variable as V
-import torchvision.models as models
+from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms as trn
 from torch.nn import functional as F
 import os
@@ -13,6 +12,8 @@ from PIL import Image
 from tqdm import tqdm
 import pandas as pd
 import pathlib
+from Preprocessing.ImageLabeling.cpu_models import load_cpu_model, prepare_input
+from Preprocessing.image_cache import ImageCache
 
 """
 This code runs a pre-trained Places-365 CNN (https://github.com/CSAILVision/places365) on an image dataset and outputs a table with the predictions + further scene info for each image
@@ -36,19 +37,97 @@ What you need to run this (all files should already be included in the repositor
  
 Note: to just test the model you can use test_images
 Running the model on a lot of images will take a while (I can do ~10 images per second on Nvidia 2060super). 
-Note to self: Something else might be the bottleneck tho, like reading/resizing the image. Can maybe parallelize.
+The images are read and resized by DataLoader worker processes (num_workers) while the model labels them in batches (batch_size).
+On CPU, the model can be quantized or use the channels_last memory format (cpu_mode, see cpu_models.py and compare_cpu_modes.py).
+With an image cache (see Preprocessing/image_cache.py), the already resized and cropped images are read from the cache instead
+(resized with PIL like get_transform does, so the labels are the same; images that aren't RGB aren't cached and are skipped as before).
 """
 
 
+def get_transform():
+    """
+    :return: image -> model input transformation (resize to 256x256, centre crop 224x224, normalize)
+    """
+    return trn.Compose([
+        trn.Resize((256, 256)),
+        trn.CenterCrop(224),
+        trn.ToTensor(),
+        trn.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+
+def get_cached_transform():
+    """
+    :return: cached 224x224 RGB array -> model input transformation (normalize only)
+    """
+    return trn.Compose([
+        trn.ToTensor(),
+        trn.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+
+class ImageFolderDataset(Dataset):
+    """
+    Images of a folder, transformed into model inputs
+    """
+
+    def __init__(self, image_folder, images, transform, cache=None):
+        """
+        :param image_folder: image folder path
+        :param images: image file names
+        :param transform: image -> tensor transformation
+        :param cache: ImageCache of the image folder (images without a places365 view are read from the folder)
+        """
+        self.image_folder = image_folder
+        self.images = images
+        self.transform = transform
+        self.cache = cache
+        self.cached_transform = get_cached_transform()
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, i):
+        image = self.images[i]
+        if self.cache is not None and self.cache.has("places365", image):
+            return image, self.cached_transform(self.cache.get("places365", image))
+        img = Image.open(os.path.join(self.image_folder, image))
+        try:
+            return image, self.transform(img)
+        except RuntimeError as e:  # black and white images throw an error
+            print(e)
+            print(image)
+            return None
+
+
+def collate_images(batch):
+    """
+    Stacks the images of a batch, leaving out those that couldn't be transformed
+    :return: (image names, tensor of shape [batch, 3, 224, 224] or None if no image is left)
+    """
+    batch = [item for item in batch if item is not None]
+    if not batch:
+        return [], None
+    images, tensors = zip(*batch)
+    return list(images), torch.stack(tensors)
+
+
 class ImageLabeler:
 
-    def __init__(self, input_folder, output_file, architecture='resnet50', print_only=False, skip_if_exists=False):
+    def __init__(self, input_folder, output_file, architecture='resnet50', print_only=False, skip_if_exists=False, batch_size=32,
+                 num_workers=2, incremental=False, cpu_mode="fp32", image_cache=None):
         """
         :param input_folder: image folder path
         :param output_file: output csv path
         :param architecture: "resnet50", "resnet18", depending on what you downloaded (see Places365 repo link above)
         :param print_only: don't create a table, only print the classification results
         :param skip_if_exists: skip labeling of the output file already exists
+        :param batch_size: number of images labeled at once
+        :param num_workers: number of processes reading and resizing the images (0: read them in the main process)
+        :param incremental: if the output file exists (and skip_if_exists is set), only label the images that aren't in it yet
+                            and add them to it instead of skipping
+        :param cpu_mode: "fp32", "channels_last", "dynamic_int8" or "static_int8" (see cpu_models.py)
+        :param image_cache: path to an image cache of the input folder (see Preprocessing/image_cache.py)
         """
         self.input_folder = input_folder
         self.output_file = output_file
@@ -56,6 +135,11 @@ class ImageLabeler:
         self.architecture = architecture
         self.print_only = print_only
         self.skip_if_exists = skip_if_exists
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.incremental = incremental
+        self.cpu_mode = cpu_mode
+        self.image_cache = image_cache
 
     def run(self):
         """
@@ -63,9 +147,12 @@ class ImageLabeler:
         The predicted labels are saved in a csv file together with the scenes corresponding to the label (given the scene hierarchy)
         """
 
+        df_existing = None
         if os.path.exists(self.output_file) and self.skip_if_exists:
-            print("Output file already exists. Skipping. Output file at", self.output_file)
-            return
+            if not self.incremental:
+                print("Output file already exists. Skipping. Output file at", self.output_file)
+                return
+            df_existing = pd.read_csv(self.output_file)
 
         # SETUP
         # the architecture to use. Make sure to download the respective model
@@ -84,6 +171,18 @@ class ImageLabeler:
             print("Image folder not found. Using 'test_images' folder")
             image_folder = "test_images"
 
+        # read image names
+        images = os.listdir(image_folder)
+        if limit > 0:
+            images = images[:limit]
+        if df_existing is not None:
+            labeled = set(df_existing["image"])
+            images = [image for image in images if image not in labeled]
+            print("{} images already labeled, {} new images".format(len(labeled), len(images)))
+            if not len(images):
+                print("Output file is up to date. Output file at", output_file)
+                return
+
         # load the pre-trained weights
         # model_file = '%s_places365.pth.tar' % arch
         # if not os.access(model_file, os.W_OK):
@@ -92,20 +191,20 @@ class ImageLabeler:
 
 
 
-        # load resnet model from torch library
-        model = models.__dict__[arch](num_classes=365)
-        checkpoint = torch.load(model_file, map_location=lambda storage, loc: storage)
-        state_dict = {str.replace(k, 'module.', ''): v for k, v in checkpoint['state_dict'].items()}
-        model.load_state_dict(state_dict)
-        model.eval()
-
         # load the image transformer
-        centre_crop = trn.Compose([
-            trn.Resize((256, 256)),
-            trn.CenterCrop(224),
-            trn.ToTensor(),
-            trn.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-        ])
+        centre_crop = get_transform()
+        cache = ImageCache(self.image_cache) if self.image_cache is not None and os.path.exists(self.image_cache) else None
+
+        def calibration_batches():
+            # the static_int8 model is calibrated on (up to) the first 128 images when it is built
+            calibration_loader = DataLoader(ImageFolderDataset(image_folder, images[:128], centre_crop, cache), batch_size=self.batch_size,
+                                            collate_fn=collate_images)
+            for _, inputs in calibration_loader:
+                if inputs is not None:
+                    yield inputs
+
+        # load resnet model from torch library
+        model = load_cpu_model(arch, model_file, self.cpu_mode, calibration_batches=calibration_batches())
 
         # load the class label
         if not os.access(file_name, os.W_OK):
@@ -125,48 +224,38 @@ class ImageLabeler:
 
         rows = []
 
-        # read image names
-        images = os.listdir(image_folder)
-        if limit > 0:
-            images = images[:limit]
+        loader = DataLoader(ImageFolderDataset(image_folder, images, centre_crop, cache), batch_size=self.batch_size, num_workers=self.num_workers,
+                            collate_fn=collate_images)
+
+        with torch.inference_mode():
+            for batch_images, input_imgs in tqdm(loader, total=len(loader)):
+                if input_imgs is None:
+                    continue
+
+                # forward pass
+                logit = model(prepare_input(input_imgs, self.cpu_mode))
+                h_x = F.softmax(logit, 1)
+                probs, idx = h_x.topk(5, dim=1)
+
+                for image, image_probs, image_idx in zip(batch_images, probs.tolist(), idx.tolist()):
+                    # construct dataframe row with ["image", "predictions", "category"]
+                    row = [image]
+                    row.append([[classes[image_idx[i]], image_probs[i]] for i in range(0, 5)])  # get top 5 predictions as 2D array of [[category, confidence], ...]
+                    row.append(classes[image_idx[0]])  # get top prediction separately for convenience
+
+                    rows.append(row)
 
-        for image in tqdm(images):
-            # load the test image
-            img_name = os.path.join(image_folder, image)
-            # if not os.access(img_name, os.W_OK):
-            #     img_url = 'http://places.csail.mit.edu/demo/' + img_name
-            # os.system('wget ' + img_url)
-
-            img = Image.open(img_name)
-            try:
-                input_img = V(centre_crop(img).unsqueeze(0))
-            except RuntimeError as e:  # black and white images throw an error
-                print(e)
-                print(image)
-                continue
-
-            # forward pass
-            logit = model.forward(input_img)
-            h_x = F.softmax(logit, 1).data.squeeze()
-            probs, idx = h_x.sort(0, True)
-
-            # construct dataframe row with ["image", "predictions", "category"]
-            row = [image]
-            row.append(
-                [[classes[idx[i]], float(probs[i])] for i in range(0, 5)])  # get top 5 predictions as 2D array of [[category, confidence], ...]
-            row.append(classes[idx[0]])  # get top prediction separately for convenience
-
-            rows.append(row)
-
-            if print_only:
-                print('{} prediction on {}'.format(arch, img_name))
-                # output the prediction
-                for i in range(0, 5):
-                    print('{:.3f} -> {}'.format(probs[i], classes[idx[i]]))
+                    if print_only:
+                        print('{} prediction on {}'.format(arch, os.path.join(image_folder, image)))
+                        # output the prediction
+                        for i in range(0, 5):
+                            print('{:.3f} -> {}'.format(image_probs[i], classes[image_idx[i]]))
 
         df = pd.DataFrame(data=rows, columns=["image", "predictions", "category"])
 
         df = pd.merge(df, df_scene, on="category")
+        if df_existing is not None:
+            df = pd.concat([df_existing, df], ignore_index=True)
 
         if not print_only:
             df.to_csv(output_file, index=False)
@@ -0,0 +1,69 @@
+"""
+Compares the CPU modes of the Places365 model (see cpu_models.py) on an image folder (test_images by default):
+throughput and how well the predictions agree with the fp32 model.
+The images are decoded before timing, so only the model is measured.
+Run from the repository root: python -m Preprocessing.ImageLabeling.compare_cpu_modes
+"""
+
+import argparse
+import os
+import pathlib
+import time
+import torch
+import pandas as pd
+from torch.utils.data import DataLoader
+from Preprocessing.ImageLabeling.ImageLabeler import ImageFolderDataset, collate_images, get_transform
+from Preprocessing.ImageLabeling.cpu_models import CPU_MODES, load_cpu_model, prepare_input, cached_model_path
+
+
+def predict(model, mode, batches, repeats):
+    """
+    :return: (top 5 class indices of each image, images per second)
+    """
+    with torch.inference_mode():
+        model(prepare_input(batches[0], mode))  # warm-up
+        tic = time.perf_counter()
+        for _ in range(repeats):
+            top5 = torch.cat([model(prepare_input(inputs, mode)).topk(5, dim=1).indices for inputs in batches])
+        toc = time.perf_counter()
+    return top5, repeats * len(top5) / (toc - tic)
+
+
+if __name__ == "__main__":
+    resource_folder = pathlib.Path(__file__).parent.resolve()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arch", default="resnet50")
+    parser.add_argument("--image_folder", default=os.path.join(resource_folder, "test_images"))
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=5, help="number of passes over the images to time")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the cached quantized models")
+    args = parser.parse_args()
+
+    model_file = os.path.join(resource_folder, '%s_places365.pth.tar' % args.arch)
+    images = sorted(os.listdir(args.image_folder))
+    loader = DataLoader(ImageFolderDataset(args.image_folder, images, get_transform()), batch_size=args.batch_size, collate_fn=collate_images)
+    batches = [inputs for _, inputs in loader if inputs is not None]
+
+    rows = []
+    reference = None
+    for mode in CPU_MODES:
+        cache_file = cached_model_path(model_file, mode)
+        if args.rebuild and os.path.exists(cache_file):
+            os.remove(cache_file)
+        model = load_cpu_model(args.arch, model_file, mode, calibration_batches=batches)
+        top5, images_per_second = predict(model, mode, batches, args.repeats)
+        if reference is None:  # fp32 comes first
+            reference = top5
+        size = os.path.getsize(cache_file) if os.path.exists(cache_file) else os.path.getsize(model_file)
+        rows.append({
+            "mode": mode,
+            "images/s": images_per_second,
+            "model MB": size / 1e6,
+            # share of images with the same top prediction as the fp32 model
+            "top-1 agreement": (top5[:, 0] == reference[:, 0]).float().mean().item(),
+            # average share of the fp32 top 5 categories that are also in the top 5 of this mode
+            "top-5 overlap": sum(len(set(a) & set(b)) for a, b in zip(top5.tolist(), reference.tolist())) / (5 * len(top5))
+        })
+
+    print("{} images, {} threads".format(len(reference), torch.get_num_threads()))
+    print(pd.DataFrame(rows).set_index("mode").round(3).to_string())
@@ -0,0 +1,87 @@
+"""
+CPU inference variants of the Places365 model used by ImageLabeler.py
+Modes:
+- fp32: the model as downloaded
+- channels_last: fp32 model and inputs in NHWC memory format (faster convolutions on CPU with oneDNN)
+- dynamic_int8: dynamic post-training quantization. PyTorch only quantizes the linear layers dynamically (not the convolutions),
+  so this mostly shrinks the classifier.
+- static_int8: static post-training quantization of the whole network (torchvision's quantizable ResNet: fused conv/bn/relu,
+  int8 weights and activations). Needs a few images to calibrate the activation ranges on.
+The quantized models are saved as TorchScript next to the model file ([arch]_places365_[mode].pt) and only built once.
+Delete the file to rebuild it (e.g. to calibrate on other images).
+"""
+
+import os
+import torch
+import torchvision.models as models
+import torchvision.models.quantization as quantized_models
+
+CPU_MODES = ("fp32", "channels_last", "dynamic_int8", "static_int8")
+
+
+def load_places365_model(arch, model_file, quantizable=False):
+    """
+    :param arch: "resnet50", "resnet18", ...
+    :param model_file: path to the downloaded weights ([arch]_places365.pth.tar)
+    :param quantizable: load the weights into torchvision's quantizable version of the architecture
+    :return: fp32 model in eval mode
+    """
+    model = (quantized_models if quantizable else models).__dict__[arch](num_classes=365)
+    checkpoint = torch.load(model_file, map_location=lambda storage, loc: storage)
+    state_dict = {str.replace(k, 'module.', ''): v for k, v in checkpoint['state_dict'].items()}
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+def cached_model_path(model_file, mode):
+    return model_file.replace(".pth.tar", "") + "_{}.pt".format(mode)
+
+
+def load_cpu_model(arch, model_file, mode="fp32", calibration_batches=None):
+    """
+    :param arch: "resnet50", "resnet18", ...
+    :param model_file: path to the downloaded weights ([arch]_places365.pth.tar)
+    :param mode: one of CPU_MODES
+    :param calibration_batches: iterable of input batches to calibrate the static_int8 model on
+                                (only used when the quantized model isn't cached yet)
+    :return: model in eval mode (TorchScript for the quantized modes)
+    """
+    if mode not in CPU_MODES:
+        raise ValueError("Unknown CPU mode '{}', use one of {}".format(mode, CPU_MODES))
+    if mode == "fp32":
+        return load_places365_model(arch, model_file)
+    if mode == "channels_last":
+        return load_places365_model(arch, model_file).to(memory_format=torch.channels_last)
+
+    cache_file = cached_model_path(model_file, mode)
+    if os.path.exists(cache_file):
+        return torch.jit.load(cache_file)
+
+    print("Building {} model (cached at {})".format(mode, cache_file))
+    if mode == "dynamic_int8":
+        model = torch.quantization.quantize_dynamic(load_places365_model(arch, model_file), {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        if calibration_batches is None:
+            raise ValueError("static_int8 needs calibration_batches to build the quantized model")
+        model = load_places365_model(arch, model_file, quantizable=True)
+        model.fuse_model()
+        model.qconfig = torch.quantization.get_default_qconfig(torch.backends.quantized.engine)
+        torch.quantization.prepare(model, inplace=True)
+        with torch.inference_mode():
+            for inputs in calibration_batches:
+                model(inputs)
+        torch.quantization.convert(model, inplace=True)
+
+    scripted = torch.jit.trace(model, torch.zeros(1, 3, 224, 224))
+    torch.jit.save(scripted, cache_file)
+    return scripted
+
+
+def prepare_input(inputs, mode):
+    """
+    Converts an input batch to the memory format the model of the given mode expects
+    """
+    if mode == "channels_last":
+        return inputs.contiguous(memory_format=torch.channels_last)
+    return inputs
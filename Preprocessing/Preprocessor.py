@@ -6,6 +6,7 @@ from dataclasses import dataclass
 import swifter  # Using swifter for faster processing: # https://stackoverflow.com/questions/45545110/make-pandas-dataframe-apply-use-all-cores
 from tqdm import tqdm
 import re
+from Preprocessing.table_io import read_table, write_table
 
 tqdm.pandas()  # makes .progress_apply() available
 
@@ -27,10 +28,11 @@ class CTPreprocessor:
     Only pre-processing the data I need right now, may extend later.
     """
 
-    def __init__(self, input_path, output_path, skip_if_exists):
+    def __init__(self, input_path, output_path, skip_if_exists, export_csv=False):
         self.input_path = input_path
         self.output_path = output_path
         self.skip_if_exists = skip_if_exists
+        self.export_csv = export_csv
 
     def run(self):
         # Skip if the output file already exists (and skipping is allowed in the config)
@@ -53,7 +55,7 @@ class CTPreprocessor:
         # extract hashtags from the post description
         df["hashtags"] = df["description"].apply(lambda x: re.findall(r"#(\w+)", x))
 
-        df.to_csv(self.output_path, index=True)
+        write_table(df, self.output_path, index=True, export_csv=self.export_csv)
         print("Output table saved to {}".format(self.output_path))
 
 
@@ -63,10 +65,10 @@ class Preprocessor:
     """
 
     def __init__(self, input_path, output_path, dataset_name, remove_duplicates: bool, images_only: bool, year_filter, hashtag_filter_include,
-                 hashtag_filter_exclude, max_images_per_year, lowercase_hashtags: bool, skip_if_exists=False):
+                 hashtag_filter_exclude, max_images_per_year, lowercase_hashtags: bool, skip_if_exists=False, export_csv=False):
         """
-        :param input_path: input file path
-        :param output_path: output file path (file should be a csv)
+        :param input_path: input file path (csv or parquet)
+        :param output_path: output file path (csv or parquet)
         :param dataset_name: name of the processed dataset, used for printing
         :param remove_duplicates: remove duplicate posts
         :param images_only: filter out videos
@@ -76,6 +78,7 @@ class Preprocessor:
         :param max_images_per_year: if a given year has more posts (=images) than max_images_per_year, randomly draw max_images_per_year
         :param lowercase_hashtags: convert all hashtags to lowercase
         :param skip_if_exists: skip the pre-processing pipeline if the output file already exists
+        :param export_csv: if the output is a parquet file, additionally export it as csv
         """
         self.input_path = input_path
         self.output_path = output_path
@@ -90,6 +93,7 @@ class Preprocessor:
         self.max_images_per_year = max_images_per_year
         self.lowercase_hashtags = lowercase_hashtags
         self.skip_if_exists = skip_if_exists
+        self.export_csv = export_csv
 
     def run(self):
         """
@@ -104,8 +108,7 @@ class Preprocessor:
             return
 
         # Read input df
-        converters = {"timestamp": pd.to_datetime, "hashtags": literal_eval}
-        df = pd.read_csv(self.input_path, converters=converters, index_col="id")
+        df = read_table(self.input_path, index_col="id", list_columns=["hashtags", "mentions"], datetime_columns=["timestamp"])
 
         df["scrape_image"] = True
 
@@ -128,7 +131,7 @@ class Preprocessor:
         if self.max_images_per_year != -1:
             df = self.select_n_images_per_year(df, "timestamp", self.max_images_per_year)
 
-        df.to_csv(self.output_path, index=True)
+        write_table(df, self.output_path, index=True, export_csv=self.export_csv)
         print("Output table saved to {}".format(self.output_path))
 
     def column_stuff(self, df, casestudy):
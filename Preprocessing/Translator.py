@@ -1,16 +1,22 @@
 import pandas as pd
 import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 tqdm.pandas()  # makes .progress_apply() available
 
 from deep_translator import GoogleTranslator
-from deep_translator.exceptions import NotValidPayload
+from deep_translator.exceptions import NotValidPayload, NotValidLength
 import spacy  # +run: python -m spacy download en_core_web_sm
 from spacy.language import Language
 from spacy_langdetect import LanguageDetector
-import swifter
 from requests.exceptions import ConnectionError
+from Preprocessing.table_io import read_table, write_table
+from Preprocessing.translation_cache import TranslationCache
+from Scraper.common.util import RateLimiter
+from Scraper.common.jsonl_log import JsonlLog
 
 
 # needed for instantiation, see https://stackoverflow.com/questions/66712753/how-to-use-languagedetector-from-spacy-langdetect-package
@@ -18,12 +24,131 @@ def get_lang_detector(nlp, name):
     return LanguageDetector()
 
 
-nlp = spacy.load("en_core_web_sm")
-try:
-    Language.factory("language_detector", func=get_lang_detector)
-except ValueError:
-    pass  # factory already instantiated
-nlp.add_pipe('language_detector', last=True)
+_nlp = {}
+
+
+def get_nlp(detection_only=False):
+    """
+    Loads the spacy pipeline with the language detector on first use (loading it takes a while)
+    :param detection_only: only the components needed for language detection: the tokenizer and a rule-based sentencizer
+                           (the language detector also detects the language of each sentence, so it needs sentence boundaries).
+                           Tagger, parser, NER etc. of en_core_web_sm don't change the detected language and are not loaded.
+    """
+    if detection_only not in _nlp:
+        try:
+            Language.factory("language_detector", func=get_lang_detector)
+        except ValueError:
+            pass  # factory already instantiated
+        if detection_only:
+            nlp = spacy.blank("en")
+            nlp.add_pipe("sentencizer")
+        else:
+            nlp = spacy.load("en_core_web_sm")
+        nlp.add_pipe('language_detector', last=True)
+        _nlp[detection_only] = nlp
+    return _nlp[detection_only]
+
+
+class TranslationEngine:
+    """
+    Translates texts with the Google translator from a bounded pool of worker threads.
+    - requests are throttled by a token bucket (rate_limit requests per second)
+    - requests that fail with a ConnectionError are retried with exponential backoff
+    - short texts are packed into one request (joined by a separator) as long as the request stays below max_chars.
+      If the translation doesn't split into the same number of texts again (the translator changed the separator),
+      the texts are requested one by one instead.
+    """
+
+    separator = "\n[[#]]\n"
+
+    def __init__(self, target_language, max_workers=4, rate_limit=5, max_retries=3, backoff=2.0, max_chars=4500, pack=True):
+        """
+        :param target_language: shortcode for the language to translate into (e.g. English='en')
+        :param max_workers: number of requests in flight at the same time
+        :param rate_limit: maximum number of requests per second (None = unlimited)
+        :param max_retries: number of retries of a request that failed with a ConnectionError
+        :param backoff: seconds to wait before the first retry, doubled with every retry
+        :param max_chars: maximum length of a packed request (the translator accepts up to 5k characters)
+        :param pack: pack multiple texts into one request
+        """
+        self.target_language = target_language
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_chars = max_chars
+        self.pack = pack
+        self.local = threading.local()
+
+    def _translator(self):
+        # GoogleTranslator keeps the request parameters in instance attributes, so every thread gets its own instance
+        if not hasattr(self.local, "translator"):
+            self.local.translator = GoogleTranslator(source='auto', target=self.target_language)
+        return self.local.translator
+
+    def _request(self, text):
+        """
+        :return: the translation, "<error>" if the translator rejected the text or None if the request kept failing
+        """
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                return self._translator().translate(text)
+            except (NotValidPayload, NotValidLength) as e:
+                print("text:", text)
+                print(e)
+                return "<error>"
+            except ConnectionError as e:
+                if attempt == self.max_retries:
+                    print(e)
+                    return None
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def _translate_batch(self, texts):
+        if len(texts) == 1:
+            return [self._request(texts[0])]
+        translation = self._request(self.separator.join(texts))
+        if translation is None:
+            return [None] * len(texts)
+        parts = translation.split(self.separator.strip())
+        if translation != "<error>" and len(parts) == len(texts):
+            return [part.strip() for part in parts]
+        return [self._request(text) for text in texts]
+
+    def _batches(self, texts):
+        """
+        Packs texts into batches that fit into one request
+        """
+        batch, length = [], 0
+        for text in texts:
+            if not self.pack or len(text) + len(self.separator) > self.max_chars or self.separator.strip() in text:
+                yield [text]
+                continue
+            if batch and length + len(self.separator) + len(text) > self.max_chars:
+                yield batch
+                batch, length = [], 0
+            length += len(text) + (len(self.separator) if batch else 0)
+            batch.append(text)
+        if batch:
+            yield batch
+
+    def translate(self, texts, groups=None):
+        """
+        :param texts: list of texts
+        :param groups: optional list with a group for every text (e.g. the detected language). Only texts of the same group are packed
+                       into one request, as the translator detects a single source language per request.
+        :return: generator of (text, translation) tuples in the order the translations finish
+        """
+        texts_by_group = {}
+        for i, text in enumerate(texts):
+            texts_by_group.setdefault(groups[i] if groups is not None else None, []).append(text)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for group_texts in texts_by_group.values():
+                for batch in self._batches(group_texts):
+                    futures[executor.submit(self._translate_batch, batch)] = batch
+            for future in as_completed(futures):
+                yield from zip(futures[future], future.result())
 
 
 class Translator:
@@ -31,63 +156,81 @@ class Translator:
     Detects the language and translates text in a dataframe column
     """
 
-    def __init__(self, input_path, output_path, target_column, target_language, skip_if_exists=False):
+    def __init__(self, input_path, output_path, target_column, target_language, skip_if_exists=False, resume=True,
+                 detect_batch_size=1000, detect_n_process=1, cache_path=None, max_in_flight=4, rate_limit=5, pack_requests=True):
         """
-        :param input_path: input file path (file should be a csv)
-        :param output_path: output file path (file should be a csv)
+        :param input_path: input file path (csv or parquet)
+        :param output_path: output file path (csv or parquet)
         :param target_column: column that will be translated
         :param target_language: shortcode for the language to translate into (e.g. English='en')
         :param skip_if_exists: skip if the translation was already run on the input file previously
+        :param resume: continue a partial translation from the output file. If false, an existing output file is overwritten.
+        :param detect_batch_size: number of texts passed through the spacy pipeline at once for language detection
+        :param detect_n_process: number of processes for language detection (see spacy's Language.pipe)
+        :param cache_path: path to a translation cache (SQLite file, can be shared between datasets). Translations found in the cache
+                           aren't requested again. None: no cache.
+        :param max_in_flight: number of translation requests in flight at the same time
+        :param rate_limit: maximum number of translation requests per second (None = unlimited)
+        :param pack_requests: pack multiple short texts into one translation request
         """
-        self.df = pd.read_csv(input_path)
+        self.df = read_table(input_path, list_columns=["hashtags", "mentions"], datetime_columns=["timestamp"])
         self.output_path = output_path
+        # translations are appended to this log while translating and merged into the output table at the end
+        self.checkpoint_path = output_path + ".translations.jsonl"
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         self.target_column = target_column
         self.target_language = target_language
         self.skip_if_exists = skip_if_exists
+        self.resume = resume
+        self.detect_batch_size = detect_batch_size
+        self.detect_n_process = detect_n_process
+        self.cache = TranslationCache(cache_path) if cache_path else None
+        self.engine = TranslationEngine(target_language, max_workers=max_in_flight, rate_limit=rate_limit, pack=pack_requests)
 
     def run(self):
 
         # Check if the output file already exists
-        if os.path.exists(self.output_path):
+        if os.path.exists(self.output_path) and (self.skip_if_exists or self.resume):
             if self.skip_if_exists:
                 print("Output file already exists. Skipping. Output file at {}".format(self.output_path))
                 return
             else:
-                # Read in last checkpoint
-                self.df = pd.read_csv(self.output_path)
+                # Read in the table with the detected languages, the translations so far are replayed from the checkpoint log
+                self.df = read_table(self.output_path, list_columns=["hashtags", "mentions"], datetime_columns=["timestamp"])
         # Start new translation by detecting the language
         else:
             self.df = self.detect_language(self.df)
+            write_table(self.df, self.output_path, index=True)
+            JsonlLog(self.checkpoint_path).delete()  # translations of an earlier run
 
-        self.df = self.translate_column(self.df, self.output_path)
-        self.df.to_csv(self.output_path, index=True)
+        self.df = self.translate_column(self.df, self.checkpoint_path)
+        write_table(self.df, self.output_path, index=True)
+        JsonlLog(self.checkpoint_path).delete()
         print("Output table saved to {}".format(self.output_path))
 
     def detect_language(self, df) -> pd.DataFrame:
-        def lang_detect(text):
-            """
-            Detects the 'main' language of a given text.
-              Unfortunately, this is not very reliable (even though it uses spacy, which uses Google's langdetect https://github.com/Mimino666/langdetect)
-              The built-in language detection in e.g. Google Translate seems to be more accurate, but it's not free.
-              While language detection with a translator is not free, translating is (through some libraries).
-              Therefore you should translate all sentences that are not already detected as the target language with high confidence (which lets the translator handle all fuzzy sentences)
-            :param text: a string
-            :return: tuple of: (language, confidence score)
-            """
-            if text.isspace() or not len(text):
-                return "empty", 1.0
-            doc = nlp(text)
-            res = doc._.language  # looks like: {'language': 'en', 'score': 0.9999955763665352}
-            return res["language"], res["score"]
-
+        """
+        Detects the 'main' language of each text in the target column and adds the columns lang_og (language) and lang_score (confidence score).
+          Unfortunately, this is not very reliable (even though it uses spacy, which uses Google's langdetect https://github.com/Mimino666/langdetect)
+          The built-in language detection in e.g. Google Translate seems to be more accurate, but it's not free.
+          While language detection with a translator is not free, translating is (through some libraries).
+          Therefore you should translate all sentences that are not already detected as the target language with high confidence (which lets the translator handle all fuzzy sentences)
+        The texts are streamed through a pipeline that only contains what the language detection needs, in batches of detect_batch_size
+        and optionally in detect_n_process processes.
+        """
         # replace NAs with ""
         df[self.target_column] = df[self.target_column].replace(pd.NA, "").astype(str)
-        # detect language
+        texts = df[self.target_column]
+        empty = texts.str.isspace() | (texts.str.len() == 0)
+
         print("Detecting [{}] language".format(self.target_column))
-        lang_tuples = df[self.target_column].swifter.apply(lang_detect)
-        # turn (language, score) tuples into 2 separate lists
-        lang, score = list(zip(*lang_tuples.tolist()))
+        lang = pd.Series("empty", index=df.index, dtype=object)
+        score = pd.Series(1.0, index=df.index)
+        docs = get_nlp(detection_only=True).pipe(texts[~empty], batch_size=self.detect_batch_size, n_process=self.detect_n_process)
+        res = [doc._.language for doc in tqdm(docs, total=int((~empty).sum()))]  # looks like: {'language': 'en', 'score': 0.9999955763665352}
+        lang[~empty] = [r["language"] for r in res]
+        score[~empty] = [r["score"] for r in res]
+
         # add new language and score as new columns to the dataframe
         df["lang_og"] = lang
         df["lang_score"] = score
@@ -98,7 +241,8 @@ class Translator:
         Translates text in a target column into a target language
         >Requires having run the detect_language() function on the df first.
         Translation limitations: Text must be <5k characters (which seems to be extremely rare)
-        :param fpath: where to save the dataframe to (save every n translations in case there are rate limits etc.)
+        :param fpath: checkpoint log (jsonl) every translation is appended to, so translation can be interrupted and resumed later
+                      (in case there are quota limits etc.). Translations already in the log are not requested again.
         :param language: language shortcut, e.g. 'en'
         :param min_score: if a caption is detected as the target language with confidence score > min_score, it is not translated
         """
@@ -112,34 +256,44 @@ class Translator:
         # translation column may exist from an earlier (incomplete) run
         if translation_col not in df:
             df[translation_col] = pd.NA
-        g_translator = GoogleTranslator(source='auto', target=target_language)
+        checkpoint = JsonlLog(fpath)
+        replayed = {record["idx"]: record["translation"] for record in checkpoint}
+        if replayed:
+            df.loc[list(replayed.keys()), translation_col] = list(replayed.values())
         print("Translating [{}] to {}".format(self.target_column, target_language))
         print("total: {}, to translate: {}, of which not translated yet: {} ".format(len(df), sum(
             (df["lang_og"] != target_language) | (df["lang_score"] <= min_score)), df[translation_col].isna().sum()))
 
-        # Translate the column row by row
-        for i, (idx, row) in enumerate(tqdm(df.iterrows(), total=len(df))):
-            text, lang, score, translation = row[self.target_column], row["lang_og"], row["lang_score"], row[translation_col]
-
-            # only translate if there's not already a translation from past executions
-            if pd.isna(translation):
-                # only translate if the caption language is detected as English with high probability
-                if (lang == target_language and score > min_score) or (lang == "empty"):
-                    translation = text
-                else:
-                    try:
-                        translation = g_translator.translate(text)
-                        # time.sleep(0.1)
-                    except NotValidPayload as e:
-                        print("text:", text)
-                        print(e)
-                        translation = "<error>"
-                    except ConnectionError as e:
-                        print(e)
-                        translation = None
-                df.loc[idx, translation_col] = translation
-
-            # save df after 100 iterations so translation can be interrupted and resumed later (in case there are quota limits)
-            if i % 100 == 0:
-                df.to_csv(fpath, index=True)
+        # only translate if there's not already a translation from past executions
+        todo = df[translation_col].isna()
+        # only translate if the caption language is not detected as the target language with high probability
+        keep = ((df["lang_og"] == target_language) & (df["lang_score"] > min_score)) | (df["lang_og"] == "empty")
+        df.loc[todo & keep, translation_col] = df.loc[todo & keep, self.target_column]
+        todo &= ~keep
+
+        # every distinct text is translated once and written back to all rows (by index) that contain it
+        rows_by_text = {}
+        for idx, text in df.loc[todo, self.target_column].fillna("").astype(str).items():
+            rows_by_text.setdefault(text, []).append(idx)
+        texts, groups = [], []
+        for text, rows in rows_by_text.items():
+            translation = self.cache.get(text, target_language) if self.cache is not None else None
+            if translation is None:
+                texts.append(text)
+                groups.append(df.at[rows[0], "lang_og"])
+            else:
+                df.loc[rows, translation_col] = translation
+
+        for text, translation in tqdm(self.engine.translate(texts, groups), total=len(texts)):
+            if self.cache is not None and translation is not None and translation != "<error>":
+                self.cache.put(text, target_language, translation)
+            # failed requests (None) stay untranslated and are retried when the translation is resumed
+            if translation is not None:
+                rows = rows_by_text[text]
+                df.loc[rows, translation_col] = translation
+                for idx in rows:
+                    idx = idx.item() if hasattr(idx, "item") else idx  # numpy -> python type for json
+                    checkpoint.append(idx, {"idx": idx, "translation": translation})
+        if self.cache is not None:
+            print(self.cache.summary())
         return df
@@ -0,0 +1,265 @@
+"""
+Decoded-image cache shared by the image model stages.
+The labeler, the feature extractor and the anonymizer all read the same image folder and each of them decoded every JPEG
+and resized it to its own model input. The cache stage decodes every image and stores the resized model inputs as
+memory-mapped uint8 arrays, one array per view:
+- places365: 224x224 RGB (resized to 256x256, centre crop 224x224 - the ImageLabeler transform before normalization)
+- ssd: 300x300 BGR (the input size of the face detector; its boxes are relative, so they are scaled to the original size)
+- dir: dir_size x dir_size RGB (optional, DIR otherwise uses the images at their original size)
+Every view is computed exactly like its stage computes its input without the cache (same decoder and resize), so the results
+don't depend on whether the cache is used: places365 and dir from the image decoded with PIL, ssd from the image decoded
+with OpenCV. Images a stage skips without the cache (the labeler skips images that aren't RGB, e.g. grayscale or palette
+images) don't get that view and are read from the image folder by the stage as before.
+The original image size is stored for every image. Images that aren't in the cache are read from the image folder as before.
+"""
+
+import os
+import json
+import cv2
+import numpy as np
+from PIL import Image
+from multiprocessing import Pool
+from tqdm import tqdm
+
+
+def cache_views(dir_size=None):
+    """
+    :param dir_size: side length of the DIR view (None: no DIR view)
+    :return: dict of view name -> (height, width, channel order)
+    """
+    views = {"places365": (224, 224, "RGB"), "ssd": (300, 300, "BGR")}
+    if dir_size:
+        views["dir"] = (dir_size, dir_size, "RGB")
+    return views
+
+
+def decode_views(path, views):
+    """
+    Decodes an image and computes its views
+    :param path: image path
+    :param views: see cache_views
+    :return: tuple of (original (height, width), dict of view name -> uint8 array (height, width, 3)) with only the views
+             the image has, None if the image can't be read
+    """
+    image = cv2.imread(path)
+    if image is None:
+        return None
+    # same resize as cv2.dnn.blobFromImages, so the detections don't change
+    res = {"ssd": cv2.resize(image, (300, 300))}
+    try:
+        with Image.open(path) as pil_image:
+            if pil_image.mode == "RGB":
+                # trn.Resize((256, 256)) and trn.CenterCrop(224) of ImageLabeler.get_transform
+                res["places365"] = np.asarray(pil_image.resize((256, 256), Image.BILINEAR))[16:240, 16:240]
+            if "dir" in views:
+                height, width, _ = views["dir"]
+                res["dir"] = np.asarray(pil_image.convert("RGB").resize((width, height), Image.BILINEAR))
+    except OSError:
+        pass  # the stages reading with PIL will fail on the image as well
+    return image.shape[:2], res
+
+
+def _decode_images(task):
+    """
+    Decodes images and computes their views (run in worker processes)
+    :param task: tuple of (image paths, views)
+    :return: list of decode_views results
+    """
+    paths, views = task
+    return [decode_views(path, views) for path in paths]
+
+
+class ImageCache:
+    """
+    Files in the cache folder:
+    - [view].u8: the images of the view (uint8, (images, height, width, 3), row-major), appended chunk by chunk
+    - index.json: the views, the image names in row order, their original sizes, the views images don't have (their rows
+      are zeros) and the images that couldn't be read
+    As in the feature store, the index is written after the arrays, so it never points to rows that don't exist.
+    """
+
+    def __init__(self, folder):
+        """
+        :param folder: path to the cache folder (created if it doesn't exist)
+        """
+        self.folder = folder
+        self.index_path = os.path.join(folder, "index.json")
+        os.makedirs(folder, exist_ok=True)
+        self.views = {}
+        self.images = []
+        self.sizes = []
+        self.missing_views = {}  # image -> views the image doesn't have
+        self.failed = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.views = {view: tuple(spec) for view, spec in index["views"].items()}
+            # caches without missing_views resized every view with OpenCV and are emptied (the rows are truncated below)
+            if "missing_views" in index:
+                self.images, self.sizes, self.failed = index["images"], index["sizes"], index["failed"]
+                self.missing_views = index["missing_views"]
+        self.rows = {image: row for row, image in enumerate(self.images)}
+        self._arrays = {}  # view -> memory-mapped array (opened on first use)
+        for view in self.views:
+            end = len(self) * self.row_size(view)
+            if os.path.exists(self.view_path(view)) and os.path.getsize(self.view_path(view)) > end:
+                with open(self.view_path(view), "r+b") as f:
+                    f.truncate(end)
+
+    def __getstate__(self):
+        # memory maps aren't sent to worker processes (they would be pickled as copies), every process opens its own
+        state = dict(self.__dict__)
+        state["_arrays"] = {}
+        return state
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, image):
+        return image in self.rows
+
+    def has_view(self, view):
+        return view in self.views
+
+    def has(self, view, image):
+        """
+        :return: whether the image is cached in the given view
+        """
+        return view in self.views and image in self.rows and view not in self.missing_views.get(image, ())
+
+    def view_path(self, view):
+        return os.path.join(self.folder, "{}.u8".format(view))
+
+    def row_size(self, view):
+        height, width, _ = self.views[view]
+        return height * width * 3
+
+    def reset(self, views):
+        """
+        Deletes the cached images and sets the views
+        """
+        for view in self.views:
+            if os.path.exists(self.view_path(view)):
+                os.remove(self.view_path(view))
+        self.views, self.images, self.sizes, self.failed, self.rows, self._arrays = dict(views), [], [], [], {}, {}
+        self.missing_views = {}
+        self._write_index()
+
+    def array(self, view, mode="r"):
+        """
+        :return: memory-mapped (images, height, width, 3) array of the view
+        """
+        if view not in self._arrays or len(self._arrays[view]) != len(self) or self._arrays[view].mode != mode:
+            height, width, _ = self.views[view]
+            self._arrays[view] = np.memmap(self.view_path(view), dtype=np.uint8, mode=mode, shape=(len(self), height, width, 3))
+        return self._arrays[view]
+
+    def get(self, view, image):
+        """
+        :return: the image in the given view as uint8 array (height, width, 3)
+        """
+        return np.array(self.array(view)[self.rows[image]])
+
+    def get_batch(self, view, images):
+        return [self.get(view, image) for image in images]
+
+    def size(self, image):
+        """
+        :return: original (height, width) of the image
+        """
+        return tuple(self.sizes[self.rows[image]])
+
+    def append(self, images, sizes, views):
+        """
+        Adds a chunk of images
+        :param images: image names
+        :param sizes: original (height, width) of each image
+        :param views: list of dicts of view name -> uint8 array (one per image, see decode_views)
+        """
+        for view, (height, width, _) in self.views.items():
+            with open(self.view_path(view), "ab") as f:
+                for image_views in views:
+                    array = image_views.get(view, np.zeros((height, width, 3), dtype=np.uint8))
+                    f.write(np.ascontiguousarray(array, dtype=np.uint8).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        for image, size, image_views in zip(images, sizes, views):
+            self.rows[image] = len(self.images)
+            self.images.append(image)
+            self.sizes.append(list(size))
+            self._set_missing_views(image, image_views)
+        self._write_index()
+
+    def _set_missing_views(self, image, image_views):
+        missing = [view for view in self.views if view not in image_views]
+        if missing:
+            self.missing_views[image] = missing
+        else:
+            self.missing_views.pop(image, None)
+
+    def update(self, image, path):
+        """
+        Replaces the cached views of an image (e.g. after its faces were pixelated in-place). Only the views the image has
+        are replaced: the index isn't rewritten, since the anonymizer updates images from multiple processes. A view the
+        image didn't have stays missing, so the stage reads the image from the folder.
+        :param image: image name
+        :param path: path to the new image file
+        """
+        decoded = decode_views(path, self.views)
+        if decoded is None:
+            return
+        for view, array in decoded[1].items():
+            if self.has(view, image):
+                self.array(view, mode="r+")[self.rows[image]] = array
+                self._arrays[view].flush()
+
+    def _write_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"views": self.views, "images": self.images, "sizes": self.sizes, "missing_views": self.missing_views,
+                       "failed": self.failed}, f)
+        os.replace(tmp_path, self.index_path)
+
+
+def build_image_cache(image_folder, cache_folder, dir_size=None, n_workers=1, chunk_size=256):
+    """
+    Adds all images of the image folder that aren't cached yet to the cache (the cache is rebuilt if the views changed)
+    :param image_folder: path to the image folder
+    :param cache_folder: path to the cache folder
+    :param dir_size: side length of the DIR view (None: no DIR view)
+    :param n_workers: number of processes decoding images
+    :param chunk_size: number of images decoded by a process at once (and appended to the cache at once)
+    :return: the ImageCache
+    """
+    cache = ImageCache(cache_folder)
+    views = cache_views(dir_size)
+    if cache.views != views:
+        if len(cache):
+            print("Cached views changed. Rebuilding the image cache")
+        cache.reset(views)
+
+    known = set(cache.images) | set(cache.failed)
+    missing = [image for image in sorted(os.listdir(image_folder)) if image not in known]
+    print("{} images cached, {} to add".format(len(cache), len(missing)))
+    chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    tasks = [([os.path.join(image_folder, image) for image in chunk], views) for chunk in chunks]
+
+    def add(chunk, decoded):
+        ok = [(image, res) for image, res in zip(chunk, decoded) if res is not None]
+        cache.failed.extend(image for image, res in zip(chunk, decoded) if res is None)
+        cache.append([image for image, _ in ok], [size for _, (size, _) in ok], [image_views for _, (_, image_views) in ok])
+
+    with tqdm(total=len(missing)) as progress:
+        if n_workers > 1:
+            with Pool(n_workers) as pool:
+                # imap returns the chunks in order, so they are appended in the order of the image list
+                for chunk, decoded in zip(chunks, pool.imap(_decode_images, tasks)):
+                    add(chunk, decoded)
+                    progress.update(len(chunk))
+        else:
+            for chunk, task in zip(chunks, tasks):
+                add(chunk, _decode_images(task))
+                progress.update(len(chunk))
+    if cache.failed:
+        print("{} images couldn't be read: {}".format(len(cache.failed), cache.failed[:5]))
+    return cache
@@ -0,0 +1,72 @@
+"""
+Reading and writing the tables that are passed between the pipeline stages.
+The format is chosen by the file extension:
+- .csv: list columns (e.g. hashtags) are stored as their string representation and parsed with literal_eval on reading
+- .parquet: typed columnar format (needs pyarrow), list columns and timestamps are stored natively and don't need parsing.
+  pyarrow returns list columns as numpy arrays, read_table converts all of them to lists (as read from csv), so tables
+  read from parquet can be written to csv again.
+"""
+
+import os
+from ast import literal_eval
+import numpy as np
+import pandas as pd
+
+
+def is_parquet(fpath):
+    return os.path.splitext(fpath)[1].lower() == ".parquet"
+
+
+def with_extension(fpath, extension):
+    return os.path.splitext(fpath)[0] + extension
+
+
+def read_table(fpath, index_col=None, list_columns=(), datetime_columns=(), converters=None) -> pd.DataFrame:
+    """
+    :param fpath: .csv or .parquet file
+    :param index_col: column to use as index (None: same as pd.read_csv, the index written with the table becomes a column)
+    :param list_columns: columns that hold lists (parsed from csv, empty values become [] in parquet). List columns of parquet
+                         files are always returned as lists.
+    :param datetime_columns: columns that hold timestamps
+    :param converters: additional converters for reading csv files (see pd.read_csv)
+    """
+    if is_parquet(fpath):
+        df = pd.read_parquet(fpath)
+        if not isinstance(df.index, pd.RangeIndex):
+            df = df.reset_index()
+        for column in df.columns:
+            if df[column].dtype == object and df[column].map(lambda x: isinstance(x, np.ndarray)).any():
+                # pyarrow returns list columns as numpy arrays
+                df[column] = df[column].apply(lambda x: x.tolist() if isinstance(x, np.ndarray) else x)
+        for column in list_columns:
+            if column in df.columns:
+                df[column] = df[column].apply(lambda x: [] if x is None else x)
+        if index_col is not None:
+            df = df.set_index(index_col)
+    else:
+        converters = dict(converters or {})
+        converters.update({column: literal_eval for column in list_columns})
+        df = pd.read_csv(fpath, index_col=index_col, converters=converters)
+
+    # vectorized datetime parsing (no-op for parquet, where timestamps are already typed)
+    for column in datetime_columns:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column])
+        elif df.index.name == column:
+            df.index = pd.to_datetime(df.index)
+    return df
+
+
+def write_table(df, fpath, index=True, export_csv=False):
+    """
+    :param df: dataframe
+    :param fpath: .csv or .parquet file
+    :param index: write the dataframe index
+    :param export_csv: if fpath is a parquet file, additionally export the table as csv next to it
+    """
+    if is_parquet(fpath):
+        df.to_parquet(fpath, index=index)
+        if export_csv:
+            df.to_csv(with_extension(fpath, ".csv"), index=index)
+    else:
+        df.to_csv(fpath, index=index)
@@ -0,0 +1,59 @@
+import hashlib
+import sqlite3
+import threading
+
+
+class TranslationCache:
+    """
+    On-disk cache of translations (SQLite) keyed by (hash of the text, target language).
+    Captions repeat a lot (reposts, bot captions, hashtag-only captions), within a dataset as well as across datasets,
+    so the cache file is meant to be shared by all datasets. It can be used from multiple threads and processes.
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path: path to the SQLite database file (created if it doesn't exist)
+        """
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # the timeout makes concurrent writers (e.g. datasets translated in parallel in a batch run) wait for each other
+        self.connection = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS translations (text_hash TEXT, target_language TEXT, translation TEXT, "
+                                "PRIMARY KEY (text_hash, target_language))")
+        self.connection.commit()
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def get(self, text, target_language):
+        """
+        :return: the cached translation or None
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT translation FROM translations WHERE text_hash = ? AND target_language = ?",
+                                          (self.text_hash(text), target_language)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, text, target_language, translation):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO translations (text_hash, target_language, translation) VALUES (?, ?, ?)",
+                                    (self.text_hash(text), target_language, translation))
+            self.connection.commit()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        return "Translation cache: {} hits, {} misses ({:.1%} hit rate)".format(self.hits, self.misses, self.hit_rate())
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,5 +1,6 @@
 from Scraper.common.util import save_json, read_json
 from Scraper.common.base_classes import Scraper, STATUS_UNFINISHED, STATUS_FINISHED
+from Scraper.common.jsonl_log import JsonlLog
 import pandas as pd
 import os
 import logging
@@ -37,13 +38,14 @@ class InstagramFeedScraper(Scraper):
     Scrapes Instagram data using a RapidAPI service.
     """
 
-    def __init__(self, scrape_folder, api_key, search_term, mode, max_tries=10):
+    def __init__(self, scrape_folder, api_key, search_term, mode, max_tries=10, compress=False):
         """
         :param scrape_folder: where to save the scrape results
         :param api_key: RapidAPI key
         :param search_term: a term to search Instagram with.
         :param mode: one of: 'location', 'hashtag', 'user'
         :param max_tries: number of times the request is re-tried on failure
+        :param compress: gzip-compress the stored responses
         """
         super().__init__(scrape_folder)
 
@@ -75,6 +77,9 @@ class InstagramFeedScraper(Scraper):
 
         self.max_tries = max_tries
 
+        # the responses (one per feed page) are appended to a JSONL log in the data folder
+        self.page_log = JsonlLog(os.path.join(self.data_folder, "pages.jsonl.gz" if compress else "pages.jsonl"), compress=compress)
+
         # API stuff
         self.url = "https://instagram-data1.p.rapidapi.com/{}/feed".format(mode)
         self.headers = {
@@ -144,8 +149,7 @@ class InstagramFeedScraper(Scraper):
                 end_cursor = js["end_cursor"]
                 collected_posts += len(js["collector"])
                 # save data
-                fname = "{:04d}_{}.json".format(i, end_cursor)
-                save_json(os.path.join(self.data_folder, fname), js)
+                self.page_log.append("{:04d}_{}".format(i, end_cursor), js)
                 i += 1
 
                 # save vars to config
@@ -177,6 +181,15 @@ class InstagramFeedScraper(Scraper):
         print("scrape status:", self.config["scrape_status"])
         return self.config["scrape_status"]
 
+    def _iter_pages(self):
+        """
+        Streams through the stored responses: the page log and json files from scrapes that stored one file per page
+        """
+        for fname in sorted(os.listdir(self.data_folder)):
+            if fname.endswith(".json"):
+                yield read_json(os.path.join(self.data_folder, fname))
+        yield from self.page_log
+
     def combine_scrape_results(self, skip_if_exists=True, *args, **kwargs):
         """
         combines the response json data (contains multiple posts) into a table where each row is one post
@@ -187,8 +200,7 @@ class InstagramFeedScraper(Scraper):
         else:
             print("Creating meta data table from posts..")
             rows = []
-            for fpath in os.listdir(self.data_folder):
-                js = read_json(os.path.join(self.data_folder, fpath))
+            for js in self._iter_pages():
                 for post in js["collector"]:
                     row = {}
                     row["id"] = post["id"]
@@ -223,9 +235,10 @@ class InstagramFeedScraper(Scraper):
 
     def cleanup_data(self):
         """
-        deletes the individual json files from the scrape (they've been combined into one table)
+        deletes the stored responses from the scrape (they've been combined into one table)
         Only call after combine_scrape_results has been called.
         """
+        self.page_log.delete()
 
         for fpath in os.listdir(self.data_folder):
             os.remove(os.path.join(self.data_folder, fpath))
@@ -1,13 +1,18 @@
 import sys
 
 sys.path.append('..')
-from Scraper.common.util import save_json, read_json
+from Scraper.common.util import RateLimiter
 from Scraper.common.base_classes import Scraper, STATUS_UNFINISHED, STATUS_FINISHED
+from Scraper.common.state_store import open_state_store
 import pandas as pd
 import os
 import logging
 import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 
@@ -26,24 +31,33 @@ def create_log_msg(post_id, msg):
     return "{} - {}".format(post_id, msg)
 
 
+STATE_COLUMNS = {"post_id": "INTEGER", "image_scraped": "INTEGER", "image_attempts": "INTEGER", "max_attempts": "INTEGER",
+                 "shortcode": "TEXT", "image_url": "TEXT"}
+IMAGE_DONE = "image_scraped = 1 OR image_attempts >= max_attempts"  # image has been either scraped or exceeded the max number of attempts
+
+
 class InstagramImageScraper(Scraper):
     """
     Scrapes images from Instagram given the image urls
     """
 
-    def __init__(self, scrape_folder, posts, sleep_time, max_attempts=10, skip_if_exists=True):
+    def __init__(self, scrape_folder, posts, sleep_time, max_attempts=10, skip_if_exists=True, max_in_flight=8, rate_limit=None):
         """
         The scrape will go over each post in 'posts' and attempt to scrape it.
         After it has reached the bottom of the posts list, it will re-do the scrape for all failed posts.
         This process is repeated until each post is either successfully scraped or has 'max_attempts' failed attempts.
         :param scrape_folder: folder where results and scrape data will be stored to.
         :param posts: Iterable that contains 3 lists: post ids, post shortcodes, image urls
-        :param sleep_time: time to wait between scrapes in seconds.
+        :param sleep_time: time each download worker waits between scrapes in seconds.
         :param max_attempts: scraper will stop trying to scrape a post if it has failed at least max_attempts times.
         :param skip_if_exists: skip images that already exist in the output folder
+        :param max_in_flight: maximum number of concurrent downloads
+        :param rate_limit: maximum number of requests per second per host (None = unlimited)
         """
         super().__init__(scrape_folder)
         self.skip_if_exists = skip_if_exists
+        self.max_in_flight = max_in_flight
+        self.rate_limit = rate_limit
 
         post_ids, shortcodes, image_urls = posts
 
@@ -53,21 +67,17 @@ class InstagramImageScraper(Scraper):
         os.makedirs(self.image_folder, exist_ok=True)
 
         # Load scrape config if there is an existing one, else create new one
+        # the config lives in an indexed SQLite store, scraping_config.csv is a snapshot written after each scrape round
         self.config_file = os.path.join(self.scrape_folder, "scraping_config.csv")
-        if os.path.exists(self.config_file):
-            print("Resuming scrape from existing config...")
-            self._read_config()
-        else:
-            print("Initializing new scrape...")
-            self.config = pd.DataFrame(data={
-                "post_id": post_ids,
-                "image_scraped": [0] * len(post_ids),  # 0=no, 1=yes
-                "image_attempts": [0] * len(post_ids),  # number of attempted scrapes
-                "max_attempts": [max_attempts] * len(post_ids),
-                "shortcode": shortcodes,
-                "image_url": image_urls
-            })
-            self._save_config()
+        self.initial_config = pd.DataFrame(data={
+            "post_id": post_ids,
+            "image_scraped": [0] * len(post_ids),  # 0=no, 1=yes
+            "image_attempts": [0] * len(post_ids),  # number of attempted scrapes
+            "max_attempts": [max_attempts] * len(post_ids),
+            "shortcode": shortcodes,
+            "image_url": image_urls
+        })
+        self._read_config()
 
         logging.basicConfig(filename=os.path.join(scrape_folder, 'scraping_log.txt'),
                             format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
@@ -76,16 +86,33 @@ class InstagramImageScraper(Scraper):
 
         self.sleep_time = sleep_time
 
+        # one persistent session for all downloads so connections are kept alive and re-used
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_in_flight, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'})
+        self.rate_limiters = {}  # host -> RateLimiter
+        self.rate_limiters_lock = threading.Lock()
+
+    def _wait_for_rate_limit(self, url):
+        host = urlparse(url).netloc
+        with self.rate_limiters_lock:
+            if host not in self.rate_limiters:
+                self.rate_limiters[host] = RateLimiter(self.rate_limit)
+            limiter = self.rate_limiters[host]
+        limiter.acquire()
+
     def get_image(self, image_url):
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
-            r = requests.get(image_url, headers=headers)
+            self._wait_for_rate_limit(image_url)
+            r = self.session.get(image_url, timeout=30)
             r.raise_for_status()  # raises an HTTPError if an error has occurred during the request (e.g. 404)
             return r.content
         except requests.exceptions.HTTPError as errh:
             self.logger.error("Http error: {}".format(errh))
-            self.logger.error("Error message: {}".format(errh.response.content.decode()))
+            self.logger.error("Error message: {}".format(errh.response.content.decode(errors="replace")))
         except requests.exceptions.ConnectionError as errc:
             self.logger.error("Connection error: {}".format(errc))
         except requests.exceptions.Timeout as errt:
@@ -94,41 +121,53 @@ class InstagramImageScraper(Scraper):
             self.logger.error("Oops: Something Else: {}".format(errr))
         return None
 
+    def _download_image(self, image_url, fpath):
+        """
+        Downloads an image and saves it to fpath (runs in a download worker thread)
+        :return: whether the download succeeded
+        """
+        img = self.get_image(image_url)
+        if img is not None:
+            with open(fpath, "wb") as f:
+                f.write(img)
+        time.sleep(self.sleep_time)
+        return img is not None
+
     def scrape(self, *args, **kwargs):
         while not self.get_scrape_status(do_print=True) == STATUS_FINISHED:
-            for post_id in tqdm(self._get_undone_posts(), desc="Scraping round progress"):
-                scrape_success = False
-
-                # get post info
-                shortcode = self.config.loc[self.config["post_id"] == post_id, "shortcode"].item()
-                image_url = self.config.loc[self.config["post_id"] == post_id, "image_url"].item()
-
-                # skip post if it already exists on the disk
-                fpath = os.path.join(self.image_folder, "{}_{}.jpg".format(post_id, shortcode))
-                if os.path.exists(fpath) and self.skip_if_exists:
-                    # print(fpath, "already exists")
-                    self._increment_config(post_id, "image_scraped")
-                    scrape_success = True
-                    continue  # will go into 'finally' block
-
-                # attempt to scrape the image
-                self.logger.info(create_log_msg(shortcode, "Extracting image content..."))
-                self._increment_config(post_id, "image_attempts")
-                ####
-                ## Alternate version of the image url that doesn't expire. I have not tested this a lot so if it fails use the image url stored in thes crape data (i.e. comment the below line out)
-                image_url = "https://www.instagram.com/p/{}/media/?size=l".format(shortcode)
-                ####
-                img = get_image(image_url)
-                if img is not None:
-                    with open(fpath, "wb") as f:
-                        f.write(img)
+            # the downloads run concurrently, the config is only updated from this thread
+            with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+                futures = {}
+                # iterate over the post info of the undone posts directly instead of looking up each post
+                for post_id, shortcode, image_url in self._get_undone_posts(columns=["post_id", "shortcode", "image_url"]):
+                    # skip post if it already exists on the disk
+                    fpath = os.path.join(self.image_folder, "{}_{}.jpg".format(post_id, shortcode))
+                    if os.path.exists(fpath) and self.skip_if_exists:
+                        # print(fpath, "already exists")
+                        self._increment_config(post_id, "image_scraped")
+                        continue
+
+                    # attempt to scrape the image
+                    self.logger.info(create_log_msg(shortcode, "Extracting image content..."))
+                    ####
+                    ## Alternate version of the image url that doesn't expire. I have not tested this a lot so if it fails use the image url stored in thes crape data (i.e. comment the below line out)
+                    image_url = "https://www.instagram.com/p/{}/media/?size=l".format(shortcode)
+                    ####
+                    futures[pool.submit(self._download_image, image_url, fpath)] = (post_id, shortcode)
+
+                for future in tqdm(as_completed(futures), total=len(futures), desc="Scraping round progress"):
+                    post_id, shortcode = futures[future]
+                    scrape_success = future.result()
+                    self._increment_config(post_id, "image_attempts")
+                    if scrape_success:
                         self._increment_config(post_id, "image_scraped")
-                        scrape_success = True
-                else:
-                    print("error on post with shortcode=", shortcode)
-                time.sleep(self.sleep_time)
-                print("Scraped post {}, result: {}".format(shortcode, "success" if scrape_success else "fail"))
-                self._save_config()
+                    else:
+                        print("error on post with shortcode=", shortcode)
+                    print("Scraped post {}, result: {}".format(shortcode, "success" if scrape_success else "fail"))
+                    self._save_config()
+
+            self.config.commit()
+            self.config.export_csv(self.config_file)
 
             # for s in tqdm(range(300),
             #               desc="Short break between scrape rounds to wait for temporarily unavailable posts to come back"):
@@ -139,25 +178,25 @@ class InstagramImageScraper(Scraper):
         print("This scrape is complete. To re-do it, please create a new one in a different folder.")
 
     def _read_config(self):
-        self.config = pd.read_csv(self.config_file)
+        self.config, resumed = open_state_store(self.scrape_folder, STATE_COLUMNS, {"image_done": IMAGE_DONE}, self.initial_config)
+        print("Resuming scrape from existing config..." if resumed else "Initializing new scrape...")
 
     def _save_config(self):
-        self.config.to_csv(self.config_file, index=False)
+        self.config.commit(force=False)  # commits in batches
 
     def _increment_config(self, post_id, variable):
-        self.config.loc[self.config["post_id"] == post_id, variable] += 1
+        self.config.increment(post_id, variable)
         self._save_config()
 
-    def _get_image_done(self, df):
+    def _get_undone_posts(self, shortcode=False, columns=None):
         """
-        returns whether all image data has been either scraped or exceeded the max number of attempts
+        :param shortcode: return the shortcodes instead of the post ids
+        :param columns: if given, return tuples of these columns for each undone post
         """
-        return df[(df["image_scraped"] == 1) | (df["image_attempts"] >= df["max_attempts"])]
-
-    def _get_undone_posts(self, shortcode=False):
-        df_done = self._get_image_done(self.config)
+        if columns is not None:
+            return self.config.select(columns, where="({}) = 0".format(IMAGE_DONE))
         keyword = "shortcode" if shortcode else "post_id"
-        return list(self.config[~self.config.index.isin(df_done.index)][keyword])
+        return [row[0] for row in self.config.select([keyword], where="({}) = 0".format(IMAGE_DONE))]
 
     def get_scrape_status(self, do_print=False):
         """
@@ -166,13 +205,13 @@ class InstagramImageScraper(Scraper):
         used to view the scrape progress
         """
 
-        df = self.config
+        store = self.config
 
         data = [
-            [len(df)],
-            [len(self._get_image_done(df))],
-            [len(df[df["image_scraped"] == 1])],
-            [len(df[df["image_attempts"] >= df["max_attempts"]])]
+            [store.count()],
+            [store.count("({}) = 1".format(IMAGE_DONE))],
+            [store.count("image_scraped = 1")],
+            [store.count("image_attempts >= max_attempts")]
         ]
         res = pd.DataFrame(data=data, columns=["images"], index=["total", "done", "scraped", "failed"])
 
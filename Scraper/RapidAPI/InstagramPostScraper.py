@@ -1,8 +1,10 @@
 import sys
 
 sys.path.append('..')
-from Scraper.common.util import save_json, read_json
+from Scraper.common.util import read_json
 from Scraper.common.base_classes import Scraper, STATUS_UNFINISHED, STATUS_FINISHED
+from Scraper.common.state_store import open_state_store
+from Scraper.common.jsonl_log import JsonlLog
 import pandas as pd
 import os
 import logging
@@ -38,9 +40,17 @@ def create_log_msg(post_id, msg):
     return "{} - {}".format(post_id, msg)
 
 
+STATE_COLUMNS = {"post_id": "INTEGER", "data_scraped": "INTEGER", "image_scraped": "INTEGER", "data_attempts": "INTEGER",
+                 "image_attempts": "INTEGER", "max_attempts": "INTEGER", "shortcode": "TEXT"}
+# post data has been either scraped or exceeded the max number of attempts
+DATA_DONE = "data_scraped = 1 OR data_attempts >= max_attempts"
+# image data has been either scraped or exceeded the max number of attempts
+IMAGE_DONE = "image_scraped = 1 OR image_attempts >= max_attempts OR data_attempts >= max_attempts"
+
+
 class InstagramScraper(Scraper):
 
-    def __init__(self, scrape_folder, scrape_name, posts, api_key, logger, sleep_time, max_attempts=10):
+    def __init__(self, scrape_folder, scrape_name, posts, api_key, logger, sleep_time, max_attempts=10, compress=False):
         """
         The scrape will go over each post in 'posts' and attempt to scrape it.
         After it has reached the bottom of the posts list, it will re-do the scrape for all failed posts.
@@ -52,10 +62,15 @@ class InstagramScraper(Scraper):
         :param logger: logging module logger.
         :param sleep_time: time to wait between scrapes in seconds.
         :param max_attempts: scraper will stop trying to scrape a post if it has failed at least max_attempts times.
+        :param compress: gzip-compress the stored post data
         """
         super().__init__(scrape_folder)
         self.scrape_name = scrape_name
 
+        # the post data (one json per post) is appended to a JSONL log in the data folder, keyed by post id
+        self.post_log = JsonlLog(os.path.join(self.data_folder, "posts.jsonl.gz" if compress else "posts.jsonl"), compress=compress,
+                                 key_func=lambda js: js["id"])
+
         post_ids, shortcodes = list(zip(*posts))  # unzip
 
         assert len(post_ids) == len(set(post_ids)), "Please remove duplicate posts"
@@ -64,23 +79,19 @@ class InstagramScraper(Scraper):
         os.makedirs(self.image_folder, exist_ok=True)
 
         # Load scrape config if there is an existing one, else create new one
+        # the config lives in an indexed SQLite store, scraping_config.csv is a snapshot written after each scrape round
         self.config_file = os.path.join(self.scrape_folder, "scraping_config.csv")
-        if os.path.exists(self.config_file):
-            print("Resuming scrape from existing config...")
-            self._read_config()
-        else:
-            print("Initializing new scrape...")
-            self.config = pd.DataFrame(data={
-                "post_id": post_ids,
-                "data_scraped": [0] * len(post_ids),  # 0=no, 1=yes
-                "image_scraped": [0] * len(post_ids),  # 0=no, 1=yes
-                "data_attempts": [0] * len(post_ids),  # number of attempted scrapes
-                "image_attempts": [0] * len(post_ids),  # number of attempted scrapes
-                "max_attempts": [max_attempts] * len(post_ids),
-                "shortcode": shortcodes,
-
-            })
-            self._save_config()
+        self.initial_config = pd.DataFrame(data={
+            "post_id": post_ids,
+            "data_scraped": [0] * len(post_ids),  # 0=no, 1=yes
+            "image_scraped": [0] * len(post_ids),  # 0=no, 1=yes
+            "data_attempts": [0] * len(post_ids),  # number of attempted scrapes
+            "image_attempts": [0] * len(post_ids),  # number of attempted scrapes
+            "max_attempts": [max_attempts] * len(post_ids),
+            "shortcode": shortcodes,
+
+        })
+        self._read_config()
 
         self.url = "https://instagram-data1.p.rapidapi.com/post/info"
         self.headers = {
@@ -138,16 +149,15 @@ class InstagramScraper(Scraper):
 
     def scrape(self, *args, **kwargs):
         while not self.get_scrape_status(do_print=True) == STATUS_FINISHED:
-            for post_id in tqdm(self._get_undone_posts(), desc="Scraping round progress"):
+            # iterate over the post info of the undone posts directly instead of looking up each post
+            for post_id, shortcode in tqdm(self._get_undone_posts(columns=["post_id", "shortcode"]), desc="Scraping round progress"):
                 scrape_success = False
 
-                shortcode = self.config.loc[self.config["post_id"] == post_id, "shortcode"].item()
-
                 try:
-                    data_path = os.path.join(self.data_folder, "{}_{}.json".format(post_id, shortcode))
+                    data_path = os.path.join(self.data_folder, "{}_{}.json".format(post_id, shortcode))  # scrapes from before the post log
                     # skip post if it already exists on the disk
-                    if os.path.exists(data_path):
-                        print(data_path, "already exists")
+                    if post_id in self.post_log or os.path.exists(data_path):
+                        print(post_id, "already exists")
                         self._increment_config(post_id, "data_scraped")
                         self._increment_config(post_id, "image_scraped")
                         scrape_success = True
@@ -158,7 +168,7 @@ class InstagramScraper(Scraper):
                     self._increment_config(post_id, "data_attempts")
                     post_json = self._get_post(shortcode)
                     if post_json is not None:
-                        save_json(data_path, post_json, indent=3)
+                        self.post_log.append(post_id, post_json)
                         self.logger.info(create_log_msg(shortcode, "data extracted."))
                         self._increment_config(post_id, "data_scraped")
 
@@ -180,6 +190,9 @@ class InstagramScraper(Scraper):
                     print("Scraped post {}, result: {}".format(shortcode, "success" if scrape_success else "fail"))
                     self._save_config()
 
+            self.config.commit()
+            self.config.export_csv(self.config_file)
+
             for s in tqdm(range(300),
                           desc="Short break between scrape rounds to wait for temporarily unavailable posts to come back"):
                 time.sleep(1)
@@ -188,41 +201,35 @@ class InstagramScraper(Scraper):
         print("This scrape is complete. To re-do it, please create a new one in a different folder.")
 
     def _read_config(self):
-        self.config = pd.read_csv(self.config_file)
+        indexes = {"data_done": DATA_DONE, "image_done": IMAGE_DONE}
+        self.config, resumed = open_state_store(self.scrape_folder, STATE_COLUMNS, indexes, self.initial_config)
+        print("Resuming scrape from existing config..." if resumed else "Initializing new scrape...")
 
     def _save_config(self):
-        self.config.to_csv(self.config_file, index=False)
+        self.config.commit(force=False)  # commits in batches
 
     def _increment_config(self, post_id, variable):
-        self.config.loc[self.config["post_id"] == post_id, variable] += 1
+        self.config.increment(post_id, variable)
         self._save_config()
 
-    def _get_data_done(self, df):
-        """
-        returns whether all post data has been either scraped or exceeded the max number of attempts
+    def _get_undone_posts(self, shortcode=False, columns=None):
         """
-        return df[(df["data_scraped"] == 1) | (df["data_attempts"] >= df["max_attempts"])]
-
-    def _get_image_done(self, df):
+        :param shortcode: return the shortcodes instead of the post ids
+        :param columns: if given, return tuples of these columns for each undone post
         """
-        returns whether all image data has been either scraped or exceeded the max number of attempts
-        """
-        return df[(df["image_scraped"] == 1) | (df["image_attempts"] >= df["max_attempts"]) | (
-                df["data_attempts"] >= df["max_attempts"])]
-
-    def _get_undone_posts(self, shortcode=False):
-        df_done = self._get_data_done(self.config)
+        if columns is not None:
+            return self.config.select(columns, where="({}) = 0".format(DATA_DONE))
         keyword = "shortcode" if shortcode else "post_id"
-        return list(self.config[~self.config.index.isin(df_done.index)][keyword])
+        return [row[0] for row in self.config.select([keyword], where="({}) = 0".format(DATA_DONE))]
 
     def get_scrape_status(self, do_print=False):
-        df = self.config
+        store = self.config
 
         data = [
-            [len(df), len(df)],
-            [len(self._get_data_done(df)), len(self._get_image_done(df))],
-            [len(df[df["data_scraped"] == 1]), len(df[df["image_scraped"] == 1])],
-            [len(df[df["data_attempts"] >= df["max_attempts"]]), len(df[df["image_attempts"] >= df["max_attempts"]])]
+            [store.count(), store.count()],
+            [store.count("({}) = 1".format(DATA_DONE)), store.count("({}) = 1".format(IMAGE_DONE))],
+            [store.count("data_scraped = 1"), store.count("image_scraped = 1")],
+            [store.count("data_attempts >= max_attempts"), store.count("image_attempts >= max_attempts")]
         ]
         res = pd.DataFrame(data=data, columns=["data", "images"], index=["total", "done", "scraped", "failed"])
 
@@ -253,7 +260,19 @@ class InstagramScraper(Scraper):
         output_comments = os.path.join(result_folder, "post_comments.csv")  # comment hierarchy as table
         output_images = os.path.join(result_folder, "post_images.csv")  # table that links images to posts/users
 
-        all_jsons = os.listdir(self.data_folder)
+        def iter_posts():
+            """
+            Streams through the post jsons so they never all have to be in memory at once
+            """
+            # json files from scrapes that stored one file per post
+            legacy_files = [fname for fname in sorted(os.listdir(self.data_folder)) if fname.endswith(".json")]
+            if not legacy_files and not len(self.post_log) and os.path.exists(output_json) and skip_if_exists:
+                # only the combined file is left (e.g. the data folder has been cleaned up)
+                yield from read_json(output_json)
+                return
+            for fname in legacy_files:
+                yield read_json(os.path.join(self.data_folder, fname))
+            yield from self.post_log
 
         def shortcode_to_post_url(shortcode):
             return "https://www.instagram.com/p/{}/".format(shortcode)
@@ -361,14 +380,14 @@ class InstagramScraper(Scraper):
 
         if os.path.exists(output_json) and skip_if_exists:
             print(output_json, "already exists. Skipping.")
-            all_posts = read_json(output_json)
         else:
-            all_posts = []
-            for fname in all_jsons:
-                fpath = os.path.join(self.data_folder, fname)
-                js = read_json(fpath)
-                all_posts.append(js)
-            save_json(output_json, all_posts, indent=3)
+            # written post by post as one json list
+            with open(output_json, "w", encoding="utf-8") as f:
+                f.write("[")
+                for i, post_json in enumerate(iter_posts()):
+                    f.write(",\n" if i else "\n")
+                    json.dump(post_json, f, indent=3)
+                f.write("\n]")
             print("Saved output to {}".format(output_json))
 
         # Important info as csv (lean table)
@@ -377,7 +396,7 @@ class InstagramScraper(Scraper):
             df_all = pd.read_csv(output_csv)
             df_all["album_images"] = literal_eval(df_all["album_images"])
         else:
-            rows = [js_to_flat_dict(post_json) for post_json in all_posts]
+            rows = [js_to_flat_dict(post_json) for post_json in iter_posts()]
             df_all = pd.DataFrame(data=rows)
             df_all["timestamp"] = pd.to_datetime(df_all["timestamp"], unit="s")
             df_all.sort_values(by="timestamp", ascending=True, inplace=True)
@@ -400,9 +419,15 @@ class InstagramScraper(Scraper):
         if os.path.exists(output_comments) and skip_if_exists:
             print(output_comments, "already exists. Skipping.")
         else:
-            dfs = [js_to_comment_table(post_json) for post_json in all_posts]
-            df_comment = pd.concat(dfs, axis=0)
-            df_comment.to_csv(output_comments, index=False)
+            # appended post by post
+            header = True
+            for post_json in iter_posts():
+                df_comment = js_to_comment_table(post_json)
+                if len(df_comment):
+                    df_comment.to_csv(output_comments, index=False, mode="w" if header else "a", header=header)
+                    header = False
+            if header:  # no comments at all
+                pd.DataFrame().to_csv(output_comments, index=False)
             print("Saved output to {}".format(output_comments))
 
         # images
@@ -0,0 +1,97 @@
+"""
+Micro-benchmark for the per-post bookkeeping overhead of the post/image scrapers at different scrape sizes.
+Compares
+ - mask: the old way, boolean-masking the whole config DataFrame twice per post (shortcode + image url)
+ - indexed df: a DataFrame indexed on post_id
+ - dict: a post_id-keyed dict
+ - store lookup: primary key lookups in the SQLite state store
+ - store iteration: iterating over the undone rows of the state store directly (what the scrapers do now)
+Run from the repository root: python -m Scraper.RapidAPI.benchmark_post_lookup
+
+Results on a single CPU core (pandas 3.0, SQLite 3.40), microseconds per post, range of two runs:
+posts    mask       indexed df  dict       store lookup  store iteration
+1000     460 - 730  31 - 49     0.2 - 0.3  15 - 24       1.4 - 2.2
+10000    480 - 550  30 - 32     0.4 - 0.5  15 - 17       1.2
+100000   590 - 620  30 - 32     0.8 - 1.0  14 - 26       1.1 - 1.6
+"""
+
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from Scraper.common.state_store import ScrapeStateStore
+from Scraper.RapidAPI.InstagramImageScraper import STATE_COLUMNS, IMAGE_DONE
+
+
+def make_config(n_posts):
+    post_ids = np.arange(n_posts, dtype=np.int64) + 2698839517135761123
+    return pd.DataFrame(data={
+        "post_id": post_ids,
+        "image_scraped": [0] * n_posts,
+        "image_attempts": [0] * n_posts,
+        "max_attempts": [5] * n_posts,
+        "shortcode": ["CV0ND{:06d}".format(i) for i in range(n_posts)],
+        "image_url": ["https://www.instagram.com/p/CV0ND{:06d}/media/?size=l".format(i) for i in range(n_posts)]
+    })
+
+
+def time_per_post(func, post_ids):
+    tic = time.perf_counter()
+    for post_id in post_ids:
+        func(post_id)
+    return (time.perf_counter() - tic) / len(post_ids)
+
+
+def benchmark(n_posts, n_samples=500):
+    """
+    :param n_posts: number of posts in the scrape
+    :param n_samples: number of posts to time the lookups on
+    :return: dict of method -> seconds per post
+    """
+    config = make_config(n_posts)
+    sample = list(np.random.choice(config["post_id"], min(n_samples, n_posts), replace=False))
+    res = {}
+
+    def mask_lookup(post_id):
+        shortcode = config.loc[config["post_id"] == post_id, "shortcode"].item()
+        image_url = config.loc[config["post_id"] == post_id, "image_url"].item()
+
+    res["mask"] = time_per_post(mask_lookup, sample)
+
+    config_indexed = config.set_index("post_id")
+
+    def indexed_lookup(post_id):
+        shortcode = config_indexed.at[post_id, "shortcode"]
+        image_url = config_indexed.at[post_id, "image_url"]
+
+    res["indexed df"] = time_per_post(indexed_lookup, sample)
+
+    config_dict = {row[0]: row[1:] for row in config[["post_id", "shortcode", "image_url"]].itertuples(index=False, name=None)}
+    res["dict"] = time_per_post(lambda post_id: config_dict[post_id], sample)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = ScrapeStateStore(os.path.join(tmp_dir, "state.sqlite"), STATE_COLUMNS, indexes={"image_done": IMAGE_DONE})
+        store.insert_dataframe(config)
+
+        def store_lookup(post_id):
+            shortcode = store.get(post_id, "shortcode")
+            image_url = store.get(post_id, "image_url")
+
+        res["store lookup"] = time_per_post(store_lookup, sample)
+
+        tic = time.perf_counter()
+        rows = store.select(["post_id", "shortcode", "image_url"], where="({}) = 0".format(IMAGE_DONE))
+        for post_id, shortcode, image_url in rows:
+            pass
+        res["store iteration"] = (time.perf_counter() - tic) / n_posts
+        store.close()
+    return res
+
+
+if __name__ == "__main__":
+    results = {n_posts: benchmark(n_posts) for n_posts in [1000, 10000, 100000]}
+    df = pd.DataFrame(results).T * 1e6
+    df.index.name = "posts"
+    print("Per-post lookup overhead in microseconds:")
+    print(df.round(2).to_string())
@@ -0,0 +1,141 @@
+import os
+import gzip
+import json
+import zlib
+
+
+class JsonlLog:
+    """
+    Append-only log of json records, one record per line (JSONL), with an offset index for reading single records.
+    Replaces storing one json file per response: a scrape only writes to two files and combining the results streams
+    through the log instead of listing and opening every file.
+
+    Files:
+    - [path]: the records. If compressed, every record is its own gzip member (concatenated members are a valid gzip file),
+      so a record can still be read by seeking to its offset.
+    - [path].idx: one line per record: key<TAB>offset<TAB>length
+    Records after the last indexed record (e.g. the index is missing, or the scrape was interrupted between writing a record
+    and its index line) are found by scanning the data file and added to the index again. Only a record that was cut off
+    at the end of the file is dropped on opening the log.
+    """
+
+    def __init__(self, path, compress=False, key_func=None):
+        """
+        :param path: path of the log file (e.g. data/pages.jsonl or data/pages.jsonl.gz)
+        :param compress: gzip-compress the records
+        :param key_func: record -> key, used for records that are added to the index again (None: their position in the log)
+        """
+        self.path = path
+        self.index_path = path + ".idx"
+        self.compress = compress
+        self.key_func = key_func
+        self.index = {}  # key -> offset
+        entries = []  # (key, offset, length) of the indexed records
+        rewrite_index = False
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != 3 or not line.endswith("\n"):
+                        rewrite_index = True  # index line was cut off
+                        continue
+                    entries.append((fields[0], int(fields[1]), int(fields[2])))
+        end = max([offset + length for _, offset, length in entries], default=0)
+        if os.path.exists(self.path) and os.path.getsize(self.path) > end:
+            recovered, end = self._scan(end)
+            entries += [(str(self.key_func(record)) if self.key_func is not None else str(len(entries) + i), offset, length)
+                        for i, (offset, length, record) in enumerate(recovered)]
+            rewrite_index = rewrite_index or bool(recovered)
+            if os.path.getsize(self.path) > end:
+                with open(self.path, "r+b") as f:
+                    f.truncate(end)
+        for key, offset, _ in entries:
+            self.index[key] = offset
+        if rewrite_index:
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.writelines("{}\t{}\t{}\n".format(*entry) for entry in entries)
+            os.replace(tmp_path, self.index_path)
+
+    def _scan(self, start):
+        """
+        Reads the complete records of the data file after the given offset
+        :param start: offset of the first record
+        :return: list of (offset, length, record) and the end of the last complete record
+        """
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            data = f.read()
+        records = []
+        position = 0
+        while position < len(data):
+            if self.compress:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # a single gzip member
+                try:
+                    line = decompressor.decompress(data[position:])
+                except zlib.error:
+                    break
+                if not decompressor.eof:
+                    break
+                length = len(data) - position - len(decompressor.unused_data)
+            else:
+                newline = data.find(b"\n", position)
+                if newline == -1:
+                    break
+                line = data[position:newline + 1]
+                length = len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            records.append((start + position, length, record))
+            position += length
+        return records, start + position
+
+    def __contains__(self, key):
+        return str(key) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def append(self, key, record):
+        """
+        :param key: identifier of the record, e.g. the post id
+        :param record: json-serializable object
+        """
+        data = (json.dumps(record) + "\n").encode("utf-8")
+        if self.compress:
+            data = gzip.compress(data)
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        # the index is written after the record so it never points to a record that doesn't exist
+        with open(self.index_path, "a") as f:
+            f.write("{}\t{}\t{}\n".format(key, offset, len(data)))
+        self.index[str(key)] = offset
+
+    def read(self, key):
+        offset = self.index[str(key)]
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            line = gzip.GzipFile(fileobj=f).readline() if self.compress else f.readline()
+        return json.loads(line)
+
+    def __iter__(self):
+        """
+        Streams through all records in the order they were appended
+        """
+        if not os.path.exists(self.path):
+            return
+        opener = gzip.open if self.compress else open
+        with opener(self.path, "rb") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def delete(self):
+        for fpath in [self.path, self.index_path]:
+            if os.path.exists(fpath):
+                os.remove(fpath)
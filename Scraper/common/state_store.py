@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import time
+import pandas as pd
+
+
+class ScrapeStateStore:
+    """
+    Stores the scrape state (one row per post: scraped yes/no, number of attempts, ...) in a SQLite database keyed by post id.
+    Updates are collected in a transaction and committed in batches, so updating the state of a single post doesn't
+    require rewriting the whole state like a csv file does.
+    """
+
+    def __init__(self, db_path, columns, key="post_id", indexes=None, commit_every=100, commit_interval=5):
+        """
+        :param db_path: path to the SQLite database file (created if it doesn't exist)
+        :param columns: dict of column name -> SQLite type, e.g. {"post_id": "INTEGER", "shortcode": "TEXT"}. Must include the key column.
+        :param key: name of the column that identifies a post
+        :param indexes: dict of index name -> SQL expression to index, e.g. {"image_done": "image_scraped = 1 OR image_attempts >= max_attempts"}
+                        Queries on these expressions (use the same expression) don't need to scan the whole table.
+        :param commit_every: commit() without force only commits after this many updates...
+        :param commit_interval: ...or if the last commit is longer ago than this many seconds
+        """
+        self.db_path = db_path
+        self.columns = list(columns.keys())
+        self.key = key
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+        self.connection = sqlite3.connect(db_path)
+        column_defs = ", ".join("{} {}{}".format(name, sql_type, " PRIMARY KEY" if name == key else "") for name, sql_type in columns.items())
+        self.connection.execute("CREATE TABLE IF NOT EXISTS posts ({})".format(column_defs))
+        for name, expression in (indexes or {}).items():
+            self.connection.execute("CREATE INDEX IF NOT EXISTS {} ON posts(({}))".format(name, expression))
+        self.connection.commit()
+
+    def __len__(self):
+        return self.count()
+
+    def is_empty(self):
+        return self.connection.execute("SELECT 1 FROM posts LIMIT 1").fetchone() is None
+
+    def insert_dataframe(self, df):
+        """
+        Adds posts to the store (posts that already exist are left as they are)
+        :param df: dataframe with (at least) the store columns
+        """
+        rows = df[self.columns].astype(object).where(df[self.columns].notna(), None).itertuples(index=False, name=None)
+        self.connection.executemany("INSERT OR IGNORE INTO posts ({}) VALUES ({})".format(", ".join(self.columns), ", ".join("?" * len(self.columns))),
+                                    rows)
+        self.connection.commit()
+
+    def to_dataframe(self):
+        self.commit()
+        return pd.read_sql_query("SELECT {} FROM posts ORDER BY rowid".format(", ".join(self.columns)), self.connection)
+
+    def increment(self, post_id, column):
+        self.connection.execute("UPDATE posts SET {0} = {0} + 1 WHERE {1} = ?".format(column, self.key), (post_id,))
+        self.pending += 1
+
+    def get(self, post_id, column):
+        row = self.connection.execute("SELECT {} FROM posts WHERE {} = ?".format(column, self.key), (post_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def select(self, columns, where="1"):
+        """
+        :param columns: list of column names
+        :param where: SQL condition
+        :return: list of tuples (in insertion order)
+        """
+        return self.connection.execute("SELECT {} FROM posts WHERE {} ORDER BY rowid".format(", ".join(columns), where)).fetchall()
+
+    def count(self, where="1"):
+        return self.connection.execute("SELECT COUNT(*) FROM posts WHERE {}".format(where)).fetchone()[0]
+
+    def commit(self, force=True):
+        """
+        Commits the pending updates
+        :param force: if false, only commit if enough updates are pending or the last commit is long enough ago
+        """
+        if not self.pending:
+            return
+        if force or self.pending >= self.commit_every or time.monotonic() - self.last_commit > self.commit_interval:
+            self.connection.commit()
+            self.pending = 0
+            self.last_commit = time.monotonic()
+
+    def export_csv(self, fpath):
+        self.to_dataframe().to_csv(fpath, index=False)
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def open_state_store(scrape_folder, columns, indexes, initial_df):
+    """
+    Opens the scrape state of a scrape folder ([scrape_folder]/scraping_state.sqlite).
+    If there is none yet, it's created from an existing scraping_config.csv (scrapes started before the state store existed).
+    The posts of initial_df that aren't in the store yet are always added, so a resumed scrape also scrapes posts that were
+    added to its input since it was started.
+    :return: (store, whether an existing scrape is resumed)
+    """
+    db_path = os.path.join(scrape_folder, "scraping_state.sqlite")
+    legacy_csv = os.path.join(scrape_folder, "scraping_config.csv")
+    resumed = os.path.exists(db_path) or os.path.exists(legacy_csv)
+    store = ScrapeStateStore(db_path, columns, indexes=indexes)
+    if store.is_empty() and os.path.exists(legacy_csv):
+        store.insert_dataframe(pd.read_csv(legacy_csv))
+    store.insert_dataframe(initial_df)
+    return store, resumed
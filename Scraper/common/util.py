@@ -1,4 +1,7 @@
 import json
+import threading
+import time
+
 
 def save_json(filename, data, indent=0):
     with open(filename, 'w', encoding='utf-8') as f:
@@ -7,4 +10,38 @@ def save_json(filename, data, indent=0):
 
 def read_json(filename):
     with open(filename) as json_file:
-        return json.load(json_file)
\ No newline at end of file
+        return json.load(json_file)
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket: allows on average 'rate' calls per second with bursts of up to 'burst' calls
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: calls per second (None or <= 0 means unlimited)
+        :param burst: maximum number of calls that can be made at once after being idle
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a call is allowed
+        """
+        if not self.rate or self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,109 @@
+"""
+Keeps track of what each pipeline stage was last run with, so stages only re-run when something relevant changed.
+"""
+
+import os
+import json
+import hashlib
+import inspect
+import importlib.util
+import threading
+from Scraper.common.util import save_json, read_json
+
+
+def hash_file(fpath, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class RunManifest:
+    """
+    Run manifest of a dataset, stored at [root_dir]/_manifest.json
+
+    For each stage the manifest holds a fingerprint made of
+     - the stage implementation: source of the stage class and of its delegate modules (see stages.Stage.delegates)
+     - the stage params
+     - the input file or folder contents (size + mtime + hash of each file)
+    File hashes are cached in the manifest and only recomputed if the size or mtime of a file changed.
+
+    A stage entry is written twice: when the stage starts ('complete': false) and when it has finished successfully.
+    That way an interrupted stage can still resume from its partial output if nothing changed in the meantime.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.path = os.path.join(root_dir, "_manifest.json")
+        self.lock = threading.Lock()  # stages may run in parallel
+        if os.path.exists(self.path):
+            self.data = read_json(self.path)
+        else:
+            self.data = {"stages": {}, "files": {}}
+
+    def _save(self):
+        save_json(self.path, self.data, indent=3)
+
+    def _file_fingerprint(self, fpath):
+        stat = os.stat(fpath)
+        key = os.path.relpath(fpath, self.root_dir)
+        with self.lock:
+            cached = self.data["files"].get(key)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hash_file(fpath)
+        with self.lock:
+            self.data["files"][key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def input_fingerprint(self, input_path):
+        """
+        :param input_path: file or folder (folders are walked recursively), None if the stage has no input
+        :return: hash over the names and contents of all input files
+        """
+        if input_path is None or not os.path.exists(input_path):
+            return None
+        if os.path.isfile(input_path):
+            return self._file_fingerprint(input_path)
+        h = hashlib.sha1()
+        for folder, subfolders, fnames in os.walk(input_path):
+            subfolders.sort()
+            for fname in sorted(fnames):
+                fpath = os.path.join(folder, fname)
+                h.update("{}:{}\n".format(os.path.relpath(fpath, input_path), self._file_fingerprint(fpath)).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def implementation_fingerprint(stage_cls):
+        h = hashlib.sha1(inspect.getsource(stage_cls).encode())
+        for module in getattr(stage_cls, "delegates", ()):
+            spec = importlib.util.find_spec(module)
+            if spec is not None and spec.origin and os.path.isfile(spec.origin):
+                h.update(hash_file(spec.origin).encode())
+        return h.hexdigest()
+
+    def fingerprint(self, stage_cls, params, input_path):
+        return {
+            "implementation": self.implementation_fingerprint(stage_cls),
+            "params": hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest(),
+            "input": self.input_fingerprint(input_path)
+        }
+
+    def get(self, name):
+        with self.lock:
+            return self.data["stages"].get(name)
+
+    def update(self, name, fingerprint, complete):
+        with self.lock:
+            self.data["stages"][name] = {"fingerprint": fingerprint, "complete": complete}
+            self._save()
+
+    def changes(self, name, fingerprint):
+        """
+        :return: list of the fingerprint parts that differ from the stage's last run (None if the stage has never been run)
+        """
+        entry = self.get(name)
+        if entry is None:
+            return None
+        return [key for key, value in fingerprint.items() if entry["fingerprint"].get(key) != value]
@@ -7,62 +7,331 @@ import argparse
 from colorama import Fore
 import json
 import stages as stage_classes
+from manifest import RunManifest
 import time
+import traceback
+import glob
+import contextlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
 
-def main(config, data_dir):
+def _paths_overlap(path_a, path_b):
     """
-    Handles the pipeline setup and execution (stage by stage)
+    Two stage paths overlap if they are the same or if one lies inside the other (e.g. 'images' and 'images/images')
+    """
+    if path_a is None or path_b is None:
+        return False
+    path_a, path_b = os.path.normpath(path_a), os.path.normpath(path_b)
+    return path_a == path_b or path_a.startswith(path_b + os.sep) or path_b.startswith(path_a + os.sep)
+
+
+def _stage_reads(stage):
+    """
+    Paths a stage reads from: its input and the image cache it uses instead of decoding the input images
+    """
+    return [stage["input"], stage["params"].get("image_cache")]
+
+
+def _stage_writes(stage):
+    """
+    Paths a stage writes to. Stages that work in-place (e.g. the image anonymizer) or move files out of their input
+    (the image deduplicator) also write to their input (and to the image cache of the input).
+    """
+    writes = [stage["output"]]
+    if (stage["params"].get("in_place") or stage["params"].get("move_duplicates")) and stage["input"]:
+        writes.append(stage["input"])
+        if stage["params"].get("in_place") and stage["params"].get("image_cache"):
+            writes.append(stage["params"]["image_cache"])
+    return writes
+
+
+def build_stage_graph(stages):
+    """
+    Derives the dependencies between the enabled stages from their input/output paths.
+    A stage has to wait for an earlier stage (w.r.t. the config order) if
+     - it reads what the earlier stage writes (e.g. the preprocessor reads the output of the feed scraper)
+     - it writes what the earlier stage reads (e.g. in-place anonymization has to wait for the image labeler)
+     - both write to the same path
+    :param stages: list of stage dicts as given by the config
+    :return: dict of stage name -> set of stage names it depends on
+    """
+    enabled = [stage for stage in stages if stage["enabled"]]
+    graph = {}
+    for i, stage in enumerate(enabled):
+        deps = set()
+        for earlier in enabled[:i]:
+            reads_earlier_output = any(_paths_overlap(read, path) for read in _stage_reads(stage) for path in _stage_writes(earlier))
+            writes_earlier_input = any(_paths_overlap(path, read) for path in _stage_writes(stage) for read in _stage_reads(earlier))
+            writes_earlier_output = any(_paths_overlap(path, earlier_path) for path in _stage_writes(stage) for earlier_path in _stage_writes(earlier))
+            if reads_earlier_output or writes_earlier_input or writes_earlier_output:
+                deps.add(earlier["name"])
+        graph[stage["name"]] = deps
+    return graph
+
+
+def apply_table_format(stages, table_format):
+    """
+    Switches the tables passed between stages (csv files that are the output of one stage and the input of another) to the given format.
+    Final outputs and external inputs keep their format.
+    :param stages: stage dicts as given by the config (modified in place)
+    :param table_format: "csv" or "parquet"
+    """
+    if table_format == "csv":
+        return
+    if table_format != "parquet":
+        raise ValueError("Unknown table format '{}'".format(table_format))
+    outputs = {stage["output"] for stage in stages}
+    intermediate = {stage["input"] for stage in stages if stage["input"] in outputs and stage["input"].endswith(".csv")}
+    for stage in stages:
+        for key in ["input", "output"]:
+            if stage[key] in intermediate:
+                stage[key] = stage[key][:-len(".csv")] + ".parquet"
+
+
+def run_stage(stage, root_dir, dataset_name, skip_stage_if_exists, manifest, resource_limits=None, export_csv=False):
+    """
+    Checks if a stage can be executed and if yes executes it. Timing and result are written into the stage dict.
+    If skip_stage_if_exists is set, the stage is skipped when its output exists and the run manifest shows that neither the
+    implementation, the params nor the input changed since its last successful run.
+    :param stage: stage dict as given by the config
+    :param root_dir: dataset folder
+    :param dataset_name: handle for the dataset
+    :param skip_stage_if_exists: passed on to the stage
+    :param manifest: run manifest of the dataset
+    :param resource_limits: optional dict of resource ("network"/"compute", see stages.Stage.resource) -> semaphore that has to be acquired to run a stage using that resource
+    :param export_csv: passed on to the stage (stages writing parquet tables also export them as csv)
+    """
+    name, implementation, stage_input, stage_output, params = stage["name"], stage["implementation"], stage["input"], stage["output"], stage[
+        "params"]
+    input_path = os.path.join(root_dir, stage_input) if stage_input else None
+    output_path = os.path.join(root_dir, stage_output)
+    print("---{}---".format(name))
+
+    stage_success = False
+    stage["execution time"] = None  # add it always so pandas recognizes it as a column
+    # run the stage if the input to the stage exists or is not required
+    if input_path is None or os.path.exists(input_path):
+        # dynamic instantiation of the stage classes from Pipeline.stages
+        if hasattr(stage_classes, implementation):
+            stage_cls = getattr(stage_classes, implementation)
+            fingerprint = manifest.fingerprint(stage_cls, params, input_path)
+            changes = manifest.changes(name, fingerprint)
+            entry = manifest.get(name)
+            if skip_stage_if_exists and changes == [] and entry["complete"] and os.path.exists(output_path):
+                print("Stage is up to date. Skipping. Output at {}".format(output_path))
+                stage["result"] = "Skipped"
+                print()
+                return
+            # let the stage skip/resume on its own output only if that output is still valid:
+            # - the stage has never been recorded (output from before the manifest existed)
+            # - the last run with the same fingerprint was interrupted
+            # - the stage only processes what's missing from its output (e.g. images that haven't been scraped yet)
+            # - the stage is set to process only what's missing ("incremental" param) and only its input changed
+            incremental = stage_cls.incremental or (params.get("incremental", False) and changes == ["input"])
+            skip_if_exists = skip_stage_if_exists and (changes is None or changes == [] or incremental)
+            if changes:
+                print("Stage changed since its last run ({}). Re-running.".format(", ".join(changes)))
+            manifest.update(name, fingerprint, complete=False)
+
+            limit = (resource_limits or {}).get(stage_cls.resource)
+            if limit is not None:
+                limit.acquire()
+            # TODO: add handling for each stage to tell whether the stage execution succeeded (e.g. input file was not found, error during execution) and return None in run() if it didn't succeed
+            tic = time.perf_counter()
+            # run the stage
+            try:
+                stage_cls.import_delegates()  # delegates are only loaded once a stage is actually executed
+                stage_instance = stage_cls(root_dir, dataset_name, params, export_csv=export_csv)
+                stage_success = stage_instance.run(input_path, output_path, skip_if_exists=skip_if_exists)
+            except Exception:
+                print(Fore.RED + "Stage {} failed:\n{}".format(name, traceback.format_exc()) + Fore.RESET)
+            finally:
+                if limit is not None:
+                    limit.release()
+            toc = time.perf_counter()
+            stage["execution time"] = toc - tic
+            if stage_success:
+                # fingerprint again after the run as in-place stages modify their input
+                manifest.update(name, manifest.fingerprint(stage_cls, params, input_path), complete=True)
+        else:
+            print("Stage name {} has no corresponding implementation in {}".format(name, stage_classes))
+    else:
+        print("Input expected at {} but none found.".format(input_path))
+
+    stage["result"] = "Success" if stage_success else "Fail"
+    print("---{} finished: {}---".format(name, stage["result"]))
+    print()
+
+
+def run_stage_graph(stages, graph, run, max_workers):
+    """
+    Runs the stages in dependency order, executing up to max_workers independent stages concurrently.
+    :param stages: dict of stage name -> stage dict
+    :param graph: dependencies as returned by build_stage_graph
+    :param run: function that executes a single stage dict
+    :param max_workers: maximum number of stages running at the same time
+    """
+    pending = list(graph.keys())  # keeps the config order as a tie-breaker
+    finished = set()
+    running = {}  # future -> stage name
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name in list(pending):
+                if not graph[name] <= finished:
+                    continue
+                pending.remove(name)
+                running[pool.submit(run, stages[name])] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                finished.add(running.pop(future))
+                future.result()
+
+
+def main(config, data_dir, max_workers=None, resource_limits=None):
+    """
+    Handles the pipeline setup and execution. Independent stages are executed in parallel.
     :param config: pipeline config
     :param data_dir: root folder
+    :param max_workers: maximum number of stages running at the same time (defaults to config["max_workers"] or 4)
+    :param resource_limits: optional dict of resource -> semaphore, see run_stage
+    :return: execution summary as dataframe
     """
     dataset_name = config["dataset_name"]
     skip_stage_if_exists = config["skip_stage_if_exists"]
+    if max_workers is None:
+        max_workers = config.get("max_workers", 4)
     root_dir = os.path.join(data_dir, dataset_name)
     os.makedirs(root_dir, exist_ok=True)
+    manifest = RunManifest(root_dir)
+    apply_table_format(config["stages"], config.get("table_format", "csv"))
+    export_csv = config.get("export_csv", False)
 
     print("Pipeline summary:")
     print(pd.DataFrame(config["stages"]).to_string())
 
-    # Go through each stage, check if it can be executed and if yes execute
+    # Build the dependency graph from the stage inputs/outputs and run the stages along it
     stages = {stage["name"]: stage for stage in config["stages"]}
-    for name, stage in stages.items():
-        implementation, stage_input, stage_output, enabled, params = stage["implementation"], stage["input"], stage["output"], stage[
-            "enabled"], stage["params"]
-        input_path = os.path.join(root_dir, stage_input) if stage_input else None
-        output_path = os.path.join(root_dir, stage_output)
-        if enabled:
-            print("---{}---".format(name))
-
-            stage_success = False
-            # run the stage if the input to the stage exists or is not required
-            if input_path is None or os.path.exists(input_path):
-                # dynamic instantiation of the stage classes from Pipeline.stages
-                if hasattr(stage_classes, implementation):
-                    stage_instance = getattr(stage_classes, implementation)(root_dir, dataset_name, params)
-                    # TODO: add handling for each stage to tell whether the stage execution succeeded (e.g. input file was not found, error during execution) and return None in run() if it didn't succeed
-                    tic = time.perf_counter()
-                    # run the stage
-                    stage_success = stage_instance.run(input_path, output_path, skip_if_exists=skip_stage_if_exists)
-                    toc = time.perf_counter()
-                    stages[name]["execution time"] = toc - tic
-                else:
-                    print("Stage name {} has no corresponding implementation in {}".format(name, stage_classes))
-                    stages[name]["execution time"] = None  # add it always so pandas recognizes it as a column
-            else:
-                print("Input expected at {} but none found.".format(input_path))
-                stages[name]["execution time"] = None
+    graph = build_stage_graph(config["stages"])
+    print("Stage dependencies:")
+    for name, deps in graph.items():
+        print(" {} <- {}".format(name, ", ".join(deps) if deps else "-"))
+    print()
 
-            stages[name]["result"] = "Success" if stage_success else "Fail"
-            print()
+    tic = time.perf_counter()
+    run_stage_graph(stages, graph, lambda stage: run_stage(stage, root_dir, dataset_name, skip_stage_if_exists, manifest, resource_limits, export_csv),
+                    max_workers)
+    toc = time.perf_counter()
 
     # Put everything into a  dataframe for pretty printing
     print("Pipeline execution summary:")
     df_res = pd.DataFrame(stages.values())
+    if "execution time" not in df_res.columns:  # no stage was enabled
+        df_res["execution time"] = None
+        df_res["result"] = None
     df_res["time %"] = df_res["execution time"] / df_res["execution time"].sum()
     df_res["time %"] = df_res["time %"].apply(lambda x: "{:.2%}".format(x))
     df_res["output"] = df_res["output"].apply(lambda x: os.path.basename(x))
     print(df_res[["name", "implementation", "enabled", "result", "output", "execution time", "time %"]].to_string())
+    print("Total wall time: {:.2f}s (sum of stage times: {:.2f}s)".format(toc - tic, df_res["execution time"].sum()))
+    return df_res
+
+
+def _run_config_file(config_file, data_dir, max_workers, resource_limits):
+    """
+    Runs the pipeline for one config file inside a batch worker process. The pipeline output is written to
+    [root_dir]/[dataset_name]/pipeline_log.txt instead of the console.
+    :return: (dataset name, execution summary or None if the pipeline crashed, wall time)
+    """
+    with open(config_file) as json_file:
+        config = json.load(json_file)
+    root_dir = os.path.join(data_dir, config["dataset_name"])
+    os.makedirs(root_dir, exist_ok=True)
+    tic = time.perf_counter()
+    with open(os.path.join(root_dir, "pipeline_log.txt"), "w") as log_file, contextlib.redirect_stdout(log_file):
+        try:
+            df_res = main(config, data_dir, max_workers=max_workers, resource_limits=resource_limits)
+        except Exception:
+            print(traceback.format_exc())
+            df_res = None
+    return config["dataset_name"], df_res, time.perf_counter() - tic
+
+
+def run_batch(config_files, data_dir, processes, network_limit, compute_limit, max_workers=None):
+    """
+    Runs the pipeline for multiple datasets concurrently, one process per dataset.
+    The number of network-bound (scraping, translation) and compute-bound (labeling, feature vectors, anonymization) stages
+    running at the same time is limited across all datasets.
+    :param config_files: list of pipeline config paths
+    :param data_dir: root folder
+    :param processes: maximum number of datasets processed at the same time
+    :param network_limit: maximum number of network-bound stages running at the same time
+    :param compute_limit: maximum number of compute-bound stages running at the same time
+    :param max_workers: maximum number of stages running at the same time within a dataset
+    :return: combined execution summary as dataframe
+    """
+    print("Running {} pipelines with {} processes (network-bound stages: {}, compute-bound stages: {})".format(
+        len(config_files), processes, network_limit, compute_limit))
+    dfs = []
+    with multiprocessing.Manager() as manager:
+        resource_limits = {"network": manager.BoundedSemaphore(network_limit), "compute": manager.BoundedSemaphore(compute_limit)}
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = {pool.submit(_run_config_file, config_file, data_dir, max_workers, resource_limits): config_file for config_file in
+                       config_files}
+            for future in as_completed(futures):
+                try:
+                    dataset_name, df_res, wall_time = future.result()
+                except Exception as e:
+                    print(Fore.RED + "Pipeline for {} crashed: {}".format(futures[future], e) + Fore.RESET)
+                    continue
+                if df_res is None:
+                    print(Fore.RED + "Pipeline for {} crashed, see {}".format(dataset_name, os.path.join(data_dir, dataset_name, "pipeline_log.txt")) + Fore.RESET)
+                    continue
+                print("Finished {} in {:.2f}s".format(dataset_name, wall_time))
+                df_res.insert(0, "dataset", dataset_name)
+                dfs.append(df_res)
+
+    if not len(dfs):
+        return None
+    # Put everything into a  dataframe for pretty printing
+    df_all = pd.concat(dfs, ignore_index=True)
+    df_all = df_all[df_all["enabled"] == True]
+    print("Batch execution summary:")
+    print(df_all[["dataset", "name", "implementation", "result", "output", "execution time"]].to_string())
+    print()
+    print(df_all.pivot_table(index="dataset", columns="result", values="name", aggfunc="count", fill_value=0).to_string())
+    print()
+    print(df_all.groupby("name", sort=False)["execution time"].agg(["sum", "mean", "max"]).to_string())
+    return df_all
+
+
+def profile_startup(config):
+    """
+    Imports the delegates of all enabled stages one after the other and prints the import time per stage.
+    Modules shared between stages are only counted for the first stage that imports them.
+    :param config: pipeline config
+    """
+    rows = []
+    for stage in config["stages"]:
+        if not stage["enabled"]:
+            continue
+        stage_cls = getattr(stage_classes, stage["implementation"], None)
+        if stage_cls is None:
+            print("Stage name {} has no corresponding implementation in {}".format(stage["name"], stage_classes))
+            continue
+        try:
+            times = stage_cls.import_delegates()
+        except ImportError as e:
+            print(Fore.RED + "Could not import the delegates of stage {}: {}".format(stage["name"], e) + Fore.RESET)
+            continue
+        for module, import_time in times.items():
+            rows.append([stage["name"], stage["implementation"], module, import_time])
+    df = pd.DataFrame(data=rows, columns=["name", "implementation", "module", "import time"])
+    print("Startup profile (import time per stage):")
+    print(df.to_string())
+    print()
+    print(df.groupby("name", sort=False)["import time"].sum().to_string())
+    print("Total import time: {:.2f}s".format(df["import time"].sum()))
 
 
 if __name__ == "__main__":
@@ -71,14 +340,29 @@ if __name__ == "__main__":
 
     parser.add_argument('--config', type=str, help='path to a pipeline config file', default="config/test.json")
     parser.add_argument('--root_dir', type=str, help='path to a directory where the pipeline output will be stored', default="../data/social_media_scraping")
+    parser.add_argument('--workers', type=int, help='maximum number of stages running in parallel (overrides max_workers in the config)', default=None)
+    parser.add_argument('--profile-startup', action='store_true', help='only import the delegates of the enabled stages and report the import time per stage')
+    parser.add_argument('--batch', type=str, help='glob of pipeline config files to run concurrently, e.g. "config/*.json" (replaces --config)', default=None)
+    parser.add_argument('--processes', type=int, help='batch mode: maximum number of datasets processed at the same time', default=4)
+    parser.add_argument('--network-limit', type=int, help='batch mode: maximum number of network-bound stages running at the same time', default=4)
+    parser.add_argument('--compute-limit', type=int, help='batch mode: maximum number of compute-bound stages running at the same time', default=1)
     args = parser.parse_args()
     config_file = args.config
     data_dir = args.root_dir
 
+    if args.batch:
+        config_files = sorted(glob.glob(args.batch))
+        if len(config_files):
+            run_batch(config_files, data_dir, args.processes, args.network_limit, args.compute_limit, max_workers=args.workers)
+        else:
+            print(Fore.RED + "No config files match: {}".format(args.batch))
     # read the pipeline config from file
-    if os.path.exists(config_file):
+    elif os.path.exists(config_file):
         with open(config_file) as json_file:
             config = json.load(json_file)
-            main(config, data_dir)
+            if args.profile_startup:
+                profile_startup(config)
+            else:
+                main(config, data_dir, max_workers=args.workers)
     else:
         print(Fore.RED + "The specified config file does not exist: {}".format(config_file))
@@ -4,18 +4,15 @@ Defines implementations of the pipeline stages.
 
 import os
 from abc import ABC, abstractmethod
+import importlib
+import time
 import pandas as pd
-
-from Scraper.RapidAPI.InstagramFeedScraper import InstagramFeedScraper
-from Preprocessing.Preprocessor import Preprocessor, CTPreprocessor
-from Preprocessing.Translator import Translator
-from Scraper.RapidAPI.InstagramImageScraper import InstagramImageScraper
-from Preprocessing.ImageLabeling.ImageLabeler import ImageLabeler
-from Preprocessing.FeatureVectors.DIRAdapter import get_features
-from Preprocessing.ImageAnonymization.ImageAnonymizer import ImageAnonymizer
-from Exploration.ExploratoryAnalysis import analyze_instagram_dataset
 import json
 import warnings
+from Preprocessing.table_io import read_table, write_table, is_parquet
+
+# The delegates are imported inside run() so that only the stages of a config that are actually executed
+# load their (heavy) dependencies like torch, spaCy or OpenCV.
 
 
 class Stage(ABC):
@@ -23,15 +20,46 @@ class Stage(ABC):
     Base class for a pipeline stage
     """
 
-    def __init__(self, root_dir: str, dataset_name: str, params: dict):
+    # incremental stages only process what's missing from their output, so they can keep their output when their input changes
+    incremental = False
+    # modules the stage delegates the actual work to (imported lazily, part of the stage fingerprint in the run manifest)
+    delegates = ()
+    # what limits the stage: "network" (API/download bound), "compute" (CPU/model bound) or None
+    # used to cap the number of stages of a kind running at the same time across datasets in a batch run
+    resource = None
+
+    @classmethod
+    def import_delegates(cls) -> dict:
+        """
+        Imports the delegate modules of the stage
+        :returns: dict of module name -> import time in seconds (0 if the module had already been imported)
+        """
+        times = {}
+        for module in cls.delegates:
+            tic = time.perf_counter()
+            importlib.import_module(module)
+            times[module] = time.perf_counter() - tic
+        return times
+
+    def __init__(self, root_dir: str, dataset_name: str, params: dict, export_csv=False):
         """"
         :param root_dir: path to the folder to store the output(s) in
         :param dataset_name: handle for the dataset (not used by all stages)
         :param params: stage-specific parameters
+        :param export_csv: stages that write parquet tables additionally export them as csv
         """
         self.root_dir = root_dir
         self.dataset_name = dataset_name
         self.params = params
+        self.export_csv = export_csv
+
+    def image_cache(self):
+        """
+        :return: path to the image cache given by the "image_cache" param (w.r.t. the root directory), None if not set
+        """
+        if self.params.get("image_cache") is None:
+            return None
+        return os.path.join(self.root_dir, self.params["image_cache"])
 
     @abstractmethod
     def run(self, input_path, output_path, skip_if_exists) -> str:
@@ -45,8 +73,12 @@ class Stage(ABC):
 
 
 class InstagramFeedScraperStage(Stage):
+    delegates = ("Scraper.RapidAPI.InstagramFeedScraper",)
+    resource = "network"
 
     def run(self, input_path, output_path, skip_if_exists):
+        from Scraper.RapidAPI.InstagramFeedScraper import InstagramFeedScraper
+
         scrape_folder = os.path.join(self.root_dir, "_scrape")  # for storing the scrape data
         dfs = []  # for passing the scrape result paths onto the next stage
         # start a new scrape for each search term
@@ -66,13 +98,17 @@ class InstagramFeedScraperStage(Stage):
                     data = json.load(file)
                     api_key = data["API_KEY"]
             # initialize scraper and run the scrape
-            scraper = InstagramFeedScraper(scrape_path, api_key, search_term, self.params["type"], max_tries=self.params["max_tries"])
+            scraper = InstagramFeedScraper(scrape_path, api_key, search_term, self.params["type"], max_tries=self.params["max_tries"],
+                                           compress=self.params.get("compress", False))
             if not scraper.is_finished():
                 scraper.scrape()
             scraper.combine_scrape_results(skip_if_exists=skip_if_exists)
             posts_path = os.path.join(scrape_path, "metadata.csv")
             try:
-                posts_df = pd.read_csv(posts_path)
+                if is_parquet(output_path):
+                    posts_df = read_table(posts_path, list_columns=["hashtags", "mentions"], datetime_columns=["timestamp"])
+                else:
+                    posts_df = pd.read_csv(posts_path)
                 dfs.append(posts_df)
             except pd.errors.EmptyDataError:
                 pass
@@ -81,77 +117,184 @@ class InstagramFeedScraperStage(Stage):
         # combine results from different search terms
         if len(dfs):
             df = pd.concat(dfs)
-            df.to_csv(output_path, index=False)
+            write_table(df, output_path, index=False, export_csv=self.export_csv)
         return True
 
 
 class PreprocessorStage(Stage):
+    delegates = ("Preprocessing.Preprocessor",)
 
     def run(self, input_path, output_path, skip_if_exists):
-        Preprocessor(input_path, output_path, self.dataset_name, **self.params, skip_if_exists=skip_if_exists).run()
+        from Preprocessing.Preprocessor import Preprocessor
+
+        Preprocessor(input_path, output_path, self.dataset_name, **self.params, skip_if_exists=skip_if_exists,
+                     export_csv=self.export_csv).run()
         return True
 
 
 class CTPreprocessorStage(Stage):
+    delegates = ("Preprocessing.Preprocessor",)
 
     def run(self, input_path, output_path, skip_if_exists):
-        CTPreprocessor(input_path, output_path, skip_if_exists=skip_if_exists).run()
+        from Preprocessing.Preprocessor import CTPreprocessor
+
+        CTPreprocessor(input_path, output_path, skip_if_exists=skip_if_exists, export_csv=self.export_csv).run()
         return True
 
 
 class ExploratoryanalysisStage(Stage):
+    delegates = ("Exploration.ExploratoryAnalysis", "Exploration.plotting")
 
     def run(self, input_path, output_path, skip_if_exists):
+        from Exploration.ExploratoryAnalysis import analyze_instagram_dataset
+
         analyze_instagram_dataset(input_path, output_path, skip_if_exists=skip_if_exists)
         return True
 
 
 class TranslatorStage(Stage):
+    delegates = ("Preprocessing.Translator",)
+    resource = "network"
 
     def run(self, input_path, output_path, skip_if_exists):
+        from Preprocessing.Translator import Translator
+
+        # the translation cache is shared by all datasets in the data folder by default
+        cache_path = self.params.get("cache_path", os.path.join(os.path.dirname(self.root_dir), "_translation_cache.sqlite"))
+        # don't skip if exists cause there may be a partially translated output file, resume from it instead
+        # (unless the orchestrator found the output to be outdated)
         Translator(input_path, output_path, self.params["target_column"], self.params["target_language"],
-                   skip_if_exists=False).run()  # don't skipp if exists cause there may be a partially translated output file
+                   skip_if_exists=False, resume=skip_if_exists, detect_batch_size=self.params.get("detect_batch_size", 1000),
+                   detect_n_process=self.params.get("detect_n_process", 1), cache_path=cache_path,
+                   max_in_flight=self.params.get("max_in_flight", 4), rate_limit=self.params.get("rate_limit", 5),
+                   pack_requests=self.params.get("pack_requests", True)).run()
         return True
 
 
 class InstagramImageScraperStage(Stage):
+    delegates = ("Scraper.RapidAPI.InstagramImageScraper",)
+    resource = "network"
+    incremental = True  # already scraped images are skipped
 
     def run(self, input_path, output_path, skip_if_exists):
+        from Scraper.RapidAPI.InstagramImageScraper import InstagramImageScraper
+
         # store config etc. in "images"
         # the scraper will then scrape the images into "images/images". Potato logic I know but no idea where else to store the scraping config etc.
         output_path = os.path.dirname(output_path)
-        df_in = pd.read_csv(input_path)
+        df_in = read_table(input_path)
         # exclude images that shouldn't be scraped
         if "scrape_image" in df_in.columns:
             df_in = df_in[df_in["scrape_image"] == True]
         posts = [list(df_in["id"]), list(df_in["shortcode"]), list(df_in["thumbnail_src"])]
         # initialize scraper and run the scrape
-        scraper = InstagramImageScraper(output_path, posts, sleep_time=0, max_attempts=5, skip_if_exists=skip_if_exists)
+        scraper = InstagramImageScraper(output_path, posts, sleep_time=0, max_attempts=5, skip_if_exists=skip_if_exists,
+                                        max_in_flight=self.params.get("max_in_flight", 8), rate_limit=self.params.get("rate_limit", None))
         if not scraper.is_finished():
             scraper.scrape()
         return True
 
 
+class ImageDeduplicatorStage(Stage):
+    delegates = ("Preprocessing.Deduplication.ImageDeduplicator",)
+
+    def run(self, input_path, output_path, skip_if_exists):
+        from Preprocessing.Deduplication.ImageDeduplicator import ImageDeduplicator
+
+        ImageDeduplicator(input_path, output_path, max_distance=self.params.get("max_distance", 4),
+                          hash_size=self.params.get("hash_size", 8), move_duplicates=self.params.get("move_duplicates", False),
+                          skip_if_exists=skip_if_exists, export_csv=self.export_csv).run()
+        return True
+
+
+class ImageCacheStage(Stage):
+    delegates = ("Preprocessing.image_cache",)
+    resource = "compute"
+    incremental = True  # only images that aren't cached yet are decoded
+
+    def run(self, input_path, output_path, skip_if_exists):
+        from Preprocessing.image_cache import build_image_cache
+
+        build_image_cache(input_path, output_path, dir_size=self.params.get("dir_size", None), n_workers=self.params.get("n_workers", 1),
+                          chunk_size=self.params.get("chunk_size", 256))
+        return True
+
+
 class ImageLabelerStage(Stage):
+    delegates = ("Preprocessing.ImageLabeling.ImageLabeler", "Preprocessing.ImageLabeling.cpu_models", "Preprocessing.image_cache")
+    resource = "compute"
 
     def run(self, input_path, output_path, skip_if_exists):
-        ImageLabeler(input_path, output_path, skip_if_exists=skip_if_exists).run()
+        from Preprocessing.ImageLabeling.ImageLabeler import ImageLabeler
+
+        ImageLabeler(input_path, output_path, skip_if_exists=skip_if_exists, batch_size=self.params.get("batch_size", 32),
+                     num_workers=self.params.get("num_workers", 2), incremental=self.params.get("incremental", False),
+                     cpu_mode=self.params.get("cpu_mode", "fp32"), image_cache=self.image_cache()).run()
         return True
 
 
 class ImageFeatureVectorStage(Stage):
+    delegates = ("Preprocessing.FeatureVectors.DIRAdapter", "Preprocessing.FeatureVectors.feature_store", "Preprocessing.image_cache")
+    resource = "compute"
+    # only images without a vector in the feature store are processed
+    # (the store is emptied if the vectors in it were computed with other settings, see DIRAdapter.extraction_settings)
+    incremental = True
 
     def run(self, input_path, output_path, skip_if_exists):
+        from Preprocessing.FeatureVectors.DIRAdapter import update_feature_store
+
         image_list_file = os.path.join(os.path.dirname(input_path), "image_db.txt")
-        get_features(input_path, image_list_file, output_path, self.params["gpu_id"],
-                     repo_folder="Preprocessing/FeatureVectors/deep-image-retrieval",
-                     skip_if_exists=skip_if_exists)
+        if output_path.endswith(".npy"):
+            # configs from before the feature store: the store is kept next to the matrix, which is exported after every run
+            # (rows listed in image_db.txt as before). An existing matrix is imported into the store instead of recomputed.
+            store_folder, export_file, export_image_list = os.path.splitext(output_path)[0], output_path, image_list_file
+            legacy_file = output_path
+        else:
+            # the output is the feature store folder, optionally exported into a single .npy file next to it
+            store_folder, export_image_list, legacy_file = output_path, None, None
+            export_file = output_path + ".npy" if self.params.get("export_npy", False) else None
+        update_feature_store(input_path, store_folder, self.params["gpu_id"],
+                             repo_folder="Preprocessing/FeatureVectors/deep-image-retrieval",
+                             batch_size=self.params.get("batch_size", 8), num_workers=self.params.get("num_workers", 4),
+                             shard_size=self.params.get("shard_size", 1000), export_file=export_file,
+                             export_image_list=export_image_list, image_cache=self.image_cache(), legacy_file=legacy_file,
+                             legacy_image_list=image_list_file, reset=not skip_if_exists)
+        return True
+
+
+class RetrievalIndexStage(Stage):
+    delegates = ("Preprocessing.FeatureVectors.retrieval_index", "Preprocessing.FeatureVectors.feature_store")
+    resource = "compute"
+
+    def run(self, input_path, output_path, skip_if_exists):
+        from Preprocessing.FeatureVectors.feature_store import FeatureStore
+        from Preprocessing.FeatureVectors.retrieval_index import RetrievalIndex
+
+        if skip_if_exists and os.path.exists(os.path.join(output_path, "index.json")):
+            print("Output file already exists. Skipping. Output file at {}".format(output_path))
+            return True
+        # the feature stores of other datasets (e.g. to compare the Hamburg 2009, 2014 and 2019 datasets) are expected at the
+        # same path w.r.t. their dataset folder as the input of this stage
+        stores = {self.dataset_name: FeatureStore(input_path)}
+        for dataset in self.params.get("other_datasets", []):
+            stores[dataset] = FeatureStore(os.path.join(os.path.dirname(self.root_dir), dataset, os.path.relpath(input_path, self.root_dir)))
+        index = RetrievalIndex.build(output_path, stores, block_size=self.params.get("block_size", 8192))
+        print("Built retrieval index of {} images at {}".format(len(index), output_path))
+        if self.params.get("threshold") is not None:
+            counts = index.match_counts(self.params["threshold"])
+            write_table(counts, os.path.join(output_path, "match_counts.csv"))
         return True
 
 
 class ImageAnonymizerStage(Stage):
+    delegates = ("Preprocessing.ImageAnonymization.ImageAnonymizer", "Preprocessing.ImageAnonymization.anonymization.anonymize_face",
+                 "Preprocessing.image_cache")
+    resource = "compute"
 
     def run(self, input_path, output_path, skip_if_exists):
+        from Preprocessing.ImageAnonymization.ImageAnonymizer import ImageAnonymizer
+
         ImageAnonymizer(input_path, output_path, self.params["confidence"], in_place=self.params["in_place"],
-                        skip_if_exists=skip_if_exists).run()  # consider setting in_place=False
+                        skip_if_exists=skip_if_exists, n_workers=self.params.get("n_workers", 1),
+                        batch_size=self.params.get("batch_size", 8), image_cache=self.image_cache()).run()  # consider setting in_place=False
         return True